@@ -5,4 +5,4 @@ test -d venv || {
     exit 1
 }
 source venv/bin/activate
-python -m src.generate_csv
+python -m src.generate_csv $@
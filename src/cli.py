@@ -1,34 +1,66 @@
-"creates a temporary csv file for a single user and feeds it to update-iam-human script"
+"""prompts for a user and feeds them directly to the update-iam-human script.
 
-import csv, tempfile
-from . import main
+with `--interactive` the prompt repeats until a blank name is given or ctrl-c/ctrl-d is pressed.
+the process, its AWS and Github sessions and their caches are kept warm between users."""
+
+from . import main, logs
 import argparse
 
+FIELD_NAMES = main.INPUT_HEADER # ['name', 'email', 'iam-username']
+
 def prompt(field):
     uin = input("%s: " % field)
     return uin
 
-def cli_main(execute=False, **kwargs):
-    field_names = ['name', 'email', 'iam-username']
-    try:
-        with tempfile.NamedTemporaryFile('w+') as csv_path:
-            writer = csv.writer(csv_path, field_names)
-            writer.writerow(field_names)
+def prompt_row():
+    "returns a validated row or None if the user wants to stop"
+    while True:
+        #row = {'name': 'Fname Lname', 'email': 'f.lname@elifesciences.org', 'iam-username': 'FnameLname'}
+        row = {}
+        for field in FIELD_NAMES:
+            row[field] = prompt(field).strip()
+            if field == 'name' and not row[field]:
+                return None
+        try:
+            main.validate_row(row)
+            return row
+        except AssertionError as err:
+            print('err:', err)
 
-            #row = ['Fname Lname', 'f.lname@elifesciences.org', 'FnameLname']
-            row = list(map(prompt, field_names))
-            writer.writerow(row)
+def rotate(row, execute=False, **kwargs):
+    "plans, and optionally executes, a single row, writing a report named after the user"
+    report_name = 'cli-%s.csv' % row['iam-username'] # "cli-FooBar-report-2019-01-01.json"
+    # looking up a single user is cheaper than listing every user
+    main.process([row], report_name, execute=execute, prefetch_keys=False, **kwargs)
+    print('%s: %s (%s)' % (row['iam-username'], row['state'], row['reason']))
+    return row
 
-            csv_path.seek(0)
-            main.main(csv_path.name, execute=execute, **kwargs)
+def cli_main(execute=False, interactive=False, **kwargs):
+    try:
+        while True:
+            row = prompt_row()
+            if not row:
+                break
+            try:
+                rotate(row, execute=execute, **kwargs)
+            except Exception as err:
+                if not interactive:
+                    raise
+                # a failure to rotate one user shouldn't end the session
+                print('err:', err)
+            if not interactive:
+                break
 
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, EOFError):
         print('ctrl-c caught, quitting')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--execute', default=False, action='store_true')
+    parser.add_argument('--interactive', default=False, action='store_true', help="keep prompting for users until a blank name is given")
     parser.add_argument('--max-key-age', default=main.MAX_KEY_AGE_DAYS)
     parser.add_argument('--grace-period-days', default=main.GRACE_PERIOD_DAYS)
-    kwargs = parser.parse_args().__dict__ # {'execute': False}
+    logs.add_arguments(parser)
+    kwargs = parser.parse_args().__dict__ # {'execute': False, 'interactive': False, ...}
+    logs.configure(kwargs.pop('log_level'))
     cli_main(**kwargs)
@@ -0,0 +1,108 @@
+"""estimates the API calls and wall time `--execute` or `--execute-plan` will take, using the actions in a plan.
+
+IAM latency is measured while planning. Github and SES aren't called during planning so their latencies are guesses."""
+
+from collections import OrderedDict
+from .utils import ensure
+
+# calls made by `main.execute_and_notify` for each type of action
+ACTION_CALLS = {
+    # `delete_key` and `disable_key` list the user's keys again before mutating
+    'delete': [('iam', 'ListAccessKeys'), ('iam', 'DeleteAccessKey')],
+    'disable': [('iam', 'ListAccessKeys'), ('iam', 'UpdateAccessKey')],
+    # a new key is followed by a gist and an email
+    'create': [('iam', 'CreateAccessKey'), ('github', 'CreateGist'), ('ses', 'SendEmail')],
+}
+
+# calls made by `main.execute_planned_user_report` for each type of action.
+# the keys of a user with actions are listed once to check the plan is current, then the planned keys are mutated directly
+PLAN_CHECK_CALLS = [('iam', 'ListAccessKeys')]
+PLANNED_ACTION_CALLS = {
+    'delete': [('iam', 'DeleteAccessKey')],
+    'disable': [('iam', 'UpdateAccessKey')],
+    'create': [('iam', 'CreateAccessKey'), ('github', 'CreateGist'), ('ses', 'SendEmail')],
+}
+
+# seconds per call
+DEFAULT_LATENCY = {
+    'iam': 0.2,
+    'github': 1.0,
+    'ses': 0.2,
+}
+
+# calls per second
+# IAM is throttled at an unpublished rate, Github limits content creation to 80 requests a minute and
+# SES' default sending rate outside of the sandbox is 14 a second.
+RATE_LIMITS = {
+    'iam': 10,
+    'github': 80 / 60,
+    'ses': 14,
+}
+
+def count_calls(report_rows, planned=False):
+    """returns a map of service => operation => number of calls the actions in the given rows will make.
+    with `planned`, the calls `--execute-plan` will make executing the rows of a plan file."""
+    action_calls = PLANNED_ACTION_CALLS if planned else ACTION_CALLS
+    calls = OrderedDict((service, OrderedDict()) for service in DEFAULT_LATENCY)
+    for row in report_rows:
+        row_calls = PLAN_CHECK_CALLS if planned and row['actions'] else []
+        for action, _ in row['actions']:
+            ensure(action in action_calls, "unknown action: %s" % action)
+            row_calls = row_calls + action_calls[action]
+        for service, operation in row_calls:
+            calls[service][operation] = calls[service].get(operation, 0) + 1
+    return calls
+
+def planning_latency(num_calls, planning_seconds, concurrency=1):
+    "the average latency of an IAM call made while planning, or None if nothing was planned"
+    if num_calls and planning_seconds:
+        return planning_seconds * concurrency / num_calls
+
+def estimate(report_rows, iam_latency=None, concurrency=1, rate_limits=None, planned=False):
+    """the calls per service and operation the given rows will make, and the projected wall time of making them.
+    the calls are those of `--execute` or, with `planned`, of `--execute-plan`.
+    the time spent on each service is bounded by latency over concurrency and by the service's rate limit,
+    whichever is slower. each service is called from its own stage of a pipeline, so the stages overlap and
+    the total is that of the slowest service."""
+    ensure(concurrency > 0, "concurrency must be a positive number")
+    rate_limits = rate_limits or RATE_LIMITS
+    latency = dict(DEFAULT_LATENCY)
+    if iam_latency is not None:
+        latency['iam'] = iam_latency
+
+    calls = count_calls(report_rows, planned)
+    projected = OrderedDict()
+    for service, operations in calls.items():
+        num_calls = sum(operations.values())
+        projected[service] = round(max(num_calls * latency[service] / concurrency, num_calls / rate_limits[service]), 3)
+    projected['total'] = max(projected.values())
+
+    return {
+        'calls': calls,
+        'total-calls': sum(sum(operations.values()) for operations in calls.values()),
+        'latency': {service: round(val, 6) for service, val in latency.items()},
+        'concurrency': concurrency,
+        'rate-limits': {service: round(val, 3) for service, val in rate_limits.items()},
+        'projected-seconds': projected,
+    }
+
+def merge(estimates):
+    """combines the estimates of shards of a plan. calls are summed.
+    shards are executed on separate nodes at the same time so the projected wall time is that of the slowest shard."""
+    ensure(estimates, "no estimates to merge")
+    calls = OrderedDict()
+    for est in estimates:
+        for service, operations in est['calls'].items():
+            merged = calls.setdefault(service, OrderedDict())
+            for operation, num_calls in operations.items():
+                merged[operation] = merged.get(operation, 0) + num_calls
+    slowest = max(estimates, key=lambda est: est['projected-seconds']['total'])
+    return {
+        'calls': calls,
+        'total-calls': sum(est['total-calls'] for est in estimates),
+        'latency': slowest['latency'],
+        'concurrency': slowest['concurrency'],
+        'rate-limits': slowest['rate-limits'],
+        'projected-seconds': slowest['projected-seconds'],
+        'shards': len(estimates),
+    }
@@ -1,11 +1,15 @@
 "generates the csv input for `update_iam_human.main`"
 
 import boto3
+import argparse
+from . import profiling, logs
 from .utils import ensure, first, splitfilter, select_keys, keys
 import time
-import sys
 import os
 import csv
+import logging
+
+LOG = logging.getLogger(__name__)
 
 def client():
     return boto3.client('iam')
@@ -43,14 +47,14 @@ def idx(key, data_list):
 
 def generate_credential_report():
     iam = client()
-    print('requesting report')
+    LOG.info('requesting report', extra={'phase': 'report-fetch'})
     while True:
         resp = iam.generate_credential_report()
         # only three possible states. the other is 'COMPLETED'
         if resp['State'] not in ['STARTED', 'INPROGRESS']:
-            print('done.')
+            LOG.info('done.', extra={'phase': 'report-fetch'})
             break
-        sys.stdout.write('polling ... ')
+        LOG.debug('polling ...', extra={'phase': 'report-fetch'})
         time.sleep(2) # seconds
     ensure(resp['State'] == 'COMPLETE', "failed to generate credential report. final response: %s" % resp)
     resp = iam.get_credential_report()
@@ -58,7 +62,7 @@ def generate_credential_report():
     ensure(resp['ReportFormat'] == 'text/csv', "unexpected report format %r. final response: %s" % (resp['ReportFormat'], resp))
     filename = 'private/credentials-report.csv'
     open(filename, 'wb').write(resp['Content'])
-    print("wrote %r" % filename)
+    LOG.info("wrote %r" % filename, extra={'phase': 'report-fetch', 'path': filename})
     return filename
 
 def partition_report(path_to_credentials_report):
@@ -86,7 +90,7 @@ def partition_report(path_to_credentials_report):
     ]
     for rows, filename in report_list:
         dump_csv(filename, rows)
-        print("wrote %r" % filename)
+        LOG.info("wrote %r" % filename, extra={'phase': 'partition', 'path': filename})
 
 def generate_humans_file(humans_csv):
     """using the list of humans derived from the credentials report, create a three column csv file for use as input to `update_iam_human.main`.
@@ -110,11 +114,26 @@ def generate_humans_file(humans_csv):
             'iam-username': human.get('iam-username', row['user'])
         })
     dump_csv(outfile, rows)
-    print("wrote %r <-- this is what you want" % outfile)
+    LOG.info("wrote %r <-- this is what you want" % outfile, extra={'phase': 'humans-merge', 'path': outfile})
     return outfile
 
-if __name__ == "__main__":
+def main(profile=False, profile_dir=None):
+    profiler = profiling.Profiler(enabled=profile or bool(profile_dir), stats_dir=profile_dir)
     os.system("mkdir -p private")
-    credential_report = generate_credential_report()
-    partition_report(credential_report)
-    generate_humans_file("private/humans-report.csv")
+    with profiler.phase('report-fetch'):
+        credential_report = generate_credential_report()
+    with profiler.phase('partition'):
+        partition_report(credential_report)
+    with profiler.phase('humans-merge'):
+        generate_humans_file("private/humans-report.csv")
+    for phase in profiler.phases:
+        LOG.info('profiled phase', extra=dict(phase, duration=phase['wall-time']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', default=False, action='store_true', help="report wall time, cpu time and memory per phase")
+    parser.add_argument('--profile-dir', default=None, help="also dump cProfile stats per phase to this directory. implies --profile")
+    logs.add_arguments(parser)
+    kwargs = parser.parse_args().__dict__
+    logs.configure(kwargs.pop('log_level'))
+    main(**kwargs)
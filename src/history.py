@@ -0,0 +1,218 @@
+"""an append-only, compressed history of every report and its results, indexed by `iam-username`.
+
+each user row of a report is appended to a data file in `$history_dir` as its own gzip member. an sqlite index,
+`$history_dir/index.sqlite3`, records the username, date, type, offset and length of each row, so a user's timeline is
+read without reading or decompressing anyone else's.
+
+    $ python -m src.history query FooBar
+    $ python -m src.history import humans-report-*.json humans-results-*.json
+    $ python -m src.history compact --keep-days 730
+"""
+
+import os
+import re
+import sys
+import gzip
+import json
+import hashlib
+import sqlite3
+import logging
+import argparse
+from datetime import timedelta
+from contextlib import contextmanager
+from . import logs, utils
+from .utils import ensure
+
+LOG = logging.getLogger(__name__)
+
+HISTORY_DIR = 'history'
+INDEX_FILE = 'index.sqlite3'
+# compacting writes a new data file and switches the index over to it in a single transaction
+DATA_FILE = 'history-%s.gz' # generation
+
+# seconds to wait for another process appending to, or compacting, the same history
+LOCK_TIMEOUT = 300
+
+REPORT_RE = re.compile(r'^.+-(?P<type>report|results)-(?P<date>\d{4}-\d{2}-\d{2})\.json$')
+SHARD_RE = re.compile(r'-shard-\d+-of-\d+(?=-(report|results)-)')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    iam_username TEXT NOT NULL,
+    date TEXT NOT NULL,
+    type TEXT NOT NULL,
+    report TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_by_username ON records (iam_username);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0);
+"""
+
+def _index_path(history_dir):
+    return os.path.join(history_dir, INDEX_FILE)
+
+@contextmanager
+def _index(history_dir, write=False):
+    """a connection to the index of the history in `history_dir`, in a transaction for the whole block.
+    writers hold the index's write lock so appends and compaction never interleave. readers see a single version of
+    the index and its data file."""
+    conn = sqlite3.connect(_index_path(history_dir), timeout=LOCK_TIMEOUT, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+        if write:
+            # `executescript` would commit the transaction we just started
+            [conn.execute(statement) for statement in SCHEMA.split(';') if statement.strip()]
+        yield conn
+        conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+def _data_path(history_dir, conn):
+    "the data file the index currently points to"
+    generation = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()['value']
+    return os.path.join(history_dir, DATA_FILE % generation)
+
+def report_rows(report):
+    "every user row in a report or its results"
+    passes = report['passes']
+    if isinstance(passes, dict):
+        # results, {'notified': [...], 'unnotified': [...]}
+        passes = [row for rows in passes.values() for row in rows]
+    return passes + report['fails']
+
+def append(report_path, report, date, executed, history_dir=HISTORY_DIR):
+    "appends each user row of the report written to `report_path` on `date` (yyyy-mm-dd) to the history"
+    os.makedirs(history_dir, exist_ok=True)
+    type_of_content = 'results' if executed else 'report'
+    report_name = os.path.basename(report_path)
+    records = [{
+        'iam-username': row['iam-username'],
+        'date': date,
+        'type': type_of_content,
+        'report': report_name,
+        'row': row
+    } for row in report_rows(report)]
+    with _index(history_dir, write=True) as conn:
+        # a crash after writing the data but before committing the index leaves unindexed data, dropped by `compact`
+        entries = []
+        with open(_data_path(history_dir, conn), 'ab') as fh:
+            for record in records:
+                data = gzip.compress(utils.lossy_json_dumps(record).encode('utf-8'))
+                entries.append((record['iam-username'], date, type_of_content, report_name, row_digest(record['row']), fh.tell(), len(data)))
+                fh.write(data)
+        conn.executemany('INSERT INTO records (iam_username, date, type, report, digest, offset, length) VALUES (?, ?, ?, ?, ?, ?, ?)', entries)
+    LOG.info('appended %s rows to history' % len(records), extra={'phase': 'write-report', 'path': history_dir})
+    return len(records)
+
+def import_report(report_path, history_dir=HISTORY_DIR):
+    "appends an existing `*-report-*.json` or `*-results-*.json` file to the history"
+    match = REPORT_RE.match(os.path.basename(report_path))
+    ensure(match, "not a report or results file: %s" % report_path)
+    with open(report_path, 'r') as fh:
+        report = json.load(fh)
+    return append(report_path, report, match.group('date'), match.group('type') == 'results', history_dir)
+
+def row_digest(row):
+    "identifies a row's content, the same before and after it has been written to and read from a report file"
+    return hashlib.sha1(utils.lossy_json_dumps(row, sort_keys=True).encode('utf-8')).hexdigest()
+
+def unsharded(report_name):
+    "'humans-shard-1-of-2-results-2019-01-01.json' => 'humans-results-2019-01-01.json'"
+    return SHARD_RE.sub('', report_name)
+
+def _dedupe(entries):
+    """drops a shard's record of a row once the merged report of the shards has recorded the same row.
+    everything else is kept, including separate runs on the same day. returns entries by date, then in the
+    order they were appended."""
+    def run_of(entry):
+        return entry['date'], entry['type'], unsharded(entry['report']), entry['digest']
+
+    merged = {run_of(entry): entry['seq'] for entry in entries if entry['report'] == unsharded(entry['report'])}
+    kept = [entry for entry in entries
+            if entry['report'] == unsharded(entry['report']) or merged.get(run_of(entry), 0) < entry['seq']]
+    return sorted(kept, key=lambda entry: (entry['date'], entry['seq']))
+
+def _read(fh, entry):
+    fh.seek(entry['offset'])
+    return fh.read(entry['length'])
+
+def query(iam_username, history_dir=HISTORY_DIR):
+    """the timeline of a user, oldest first. a row recorded by both a shard's report and the merged report of the
+    shards appears once."""
+    if not os.path.exists(_index_path(history_dir)):
+        return []
+    with _index(history_dir) as conn:
+        entries = conn.execute('SELECT * FROM records WHERE iam_username = ?', (iam_username,)).fetchall()
+        if not entries:
+            return []
+        with open(_data_path(history_dir, conn), 'rb') as fh:
+            return [json.loads(gzip.decompress(_read(fh, entry)).decode('utf-8')) for entry in _dedupe(entries)]
+
+def compact(history_dir=HISTORY_DIR, keep_days=None):
+    """rewrites the history dropping shard records duplicated by a merged report and, if `keep_days` is given, records older than that many days.
+    the compacted records are written to a new data file and the index is switched over to it in a single transaction,
+    so an interrupted compaction leaves the history as it was. returns the number of records kept."""
+    ensure(os.path.exists(_index_path(history_dir)), "no history found: %s" % history_dir)
+    cutoff = utils.ymd(utils.utcnow() - timedelta(days=keep_days)) if keep_days is not None else None
+
+    with _index(history_dir, write=True) as conn:
+        data_path = _data_path(history_dir, conn)
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'generation'")
+        new_data_path = _data_path(history_dir, conn)
+        entries = conn.execute('SELECT * FROM records ORDER BY iam_username, seq').fetchall()
+        by_username = {}
+        [by_username.setdefault(entry['iam_username'], []).append(entry) for entry in entries
+         if not (cutoff and entry['date'] < cutoff)]
+
+        kept = []
+        # left over from an interrupted compaction, if it exists
+        with open(data_path, 'rb') as src, open(new_data_path, 'wb') as dst:
+            for iam_username in sorted(by_username):
+                for entry in _dedupe(by_username[iam_username]):
+                    data = _read(src, entry)
+                    kept.append((entry['seq'], iam_username, entry['date'], entry['type'], entry['report'], entry['digest'],
+                                 dst.tell(), len(data)))
+                    dst.write(data)
+            dst.flush()
+            os.fsync(dst.fileno())
+        conn.execute('DELETE FROM records')
+        conn.executemany('INSERT INTO records (seq, iam_username, date, type, report, digest, offset, length) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', kept)
+
+    # the index no longer points at the old data file
+    os.remove(data_path)
+    LOG.info('compacted history to %s records' % len(kept), extra={'phase': 'compact', 'path': history_dir})
+    return len(kept)
+
+if __name__ == '__main__':
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--history-dir', default=HISTORY_DIR)
+        logs.add_arguments(parser)
+        subparsers = parser.add_subparsers(dest='command', required=True)
+        query_parser = subparsers.add_parser('query', help="print the rotation timeline of a user")
+        query_parser.add_argument('iam_username')
+        import_parser = subparsers.add_parser('import', help="add existing report and results files to the history")
+        import_parser.add_argument('paths', nargs='+')
+        compact_parser = subparsers.add_parser('compact', help="drop duplicate and, optionally, old records")
+        compact_parser.add_argument('--keep-days', default=None, type=int)
+        args = parser.parse_args()
+        logs.configure(args.log_level)
+
+        if args.command == 'query':
+            print(utils.lossy_json_dumps(query(args.iam_username, args.history_dir), indent=4))
+        elif args.command == 'import':
+            [import_report(path, args.history_dir) for path in args.paths]
+        else:
+            compact(args.history_dir, args.keep_days)
+    except AssertionError as err:
+        LOG.error('err: %s' % err)
+        sys.exit(getattr(err, 'retcode', 1))
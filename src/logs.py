@@ -0,0 +1,98 @@
+"""structured logging.
+
+log records are json, one per line, and are handed to a queue. a single background thread takes records off the queue
+and writes them to stderr, so callers never block on terminal or pipe writes."""
+
+import sys
+import copy
+import time
+import atexit
+import logging
+import logging.handlers
+import queue
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from .utils import lossy_json_dumps
+
+ROOT = __name__.split('.')[0] # 'src'
+
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+# attributes present on every LogRecord. anything else was passed in via `extra`
+_STANDARD_ATTRS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__.keys()) | {'message', 'asctime'}
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            # when the event happened, not when the listener thread got around to writing it
+            'time': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update({key: val for key, val in record.__dict__.items() if key not in _STANDARD_ATTRS})
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return lossy_json_dumps(data)
+
+_FORMATTER = logging.Formatter()
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """keeps a record's traceback in its own 'exception' field.
+    the default `prepare` appends the traceback to the message, which would leave a multi-line 'message'."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exception = _FORMATTER.formatException(record.exc_info)
+        if record.stack_info:
+            record.stack = record.stack_info
+        # already formatted, the listener doesn't need the traceback objects
+        record.exc_info = record.exc_text = record.stack_info = None
+        return record
+
+class QueueListener(logging.handlers.QueueListener):
+    "a listener that remembers it has been stopped, so stopping it again, for example at exit, does nothing"
+    stopped = False
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            super().stop()
+
+def configure(level='INFO', stream=None):
+    """routes all of this program's log records through a queue to a listener thread writing json lines to `stream`.
+    returns the listener. it is stopped, and the queue flushed, on exit."""
+    logger = logging.getLogger(ROOT)
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(JSONFormatter())
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    logger.addHandler(QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+def stop(listener):
+    "flushes any queued records and stops the listener thread. safe to call more than once"
+    listener.stop()
+
+def add_arguments(parser):
+    "adds the logging options to an argparse parser"
+    parser.add_argument('--log-level', default='INFO', type=str.upper, choices=LEVELS, help="verbosity of the json log lines written to stderr")
+
+@contextmanager
+def timed(log, message, **extra):
+    "logs `message` once the block completes, with the block's `duration` in seconds"
+    start = time.perf_counter()
+    yield
+    extra['duration'] = round(time.perf_counter() - start, 6)
+    log.info(message, extra=extra)
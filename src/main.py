@@ -5,13 +5,23 @@ import sys, os, csv
 from github import Github
 from github.InputFileContent import InputFileContent
 import json
+import logging
+import time
+import threading
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from collections import OrderedDict
-from . import utils
-from .utils import ensure, ymd, splitfilter, vals, lmap, lfilter, utcnow
+from . import utils, profiling, logs, estimate, history, pipeline, shard as sharding
+from .utils import ensure, ymd, splitfilter, vals, lmap, lfilter, utcnow, stable_hash
+
+LOG = logging.getLogger(__name__)
 
 MAX_KEY_AGE_DAYS, GRACE_PERIOD_DAYS = 180, 7
 
+# number of threads making concurrent lookups
+WORKERS = 10
+
 # states
 
 UNKNOWN = '?'
@@ -27,6 +37,11 @@ NO_CREDENTIALS = 'no-credentials'
 
 MANY_CREDENTIALS = 'many-credentials'
 
+KEY_IN_USE = 'old-credentials-in-use'
+ROTATION_DEFERRED = 'rotation-deferred'
+STALE_PLAN = 'stale-plan'
+LOOKUP_FAILED = 'lookup-failed'
+
 STATE_DESCRIPTIONS = {
     IDEAL: "1 active set of credentials younger than max age of credentials",
     GRACE_PERIOD: "two active sets of credentials, one set created in the last $grace-period days",
@@ -34,9 +49,13 @@ STATE_DESCRIPTIONS = {
     NO_CREDENTIALS_ACTIVE: "credentials present but none are active",
     OLD_CREDENTIALS: "credentials are old and will be rotated",
     NO_CREDENTIALS: "no credentials exist",
+    KEY_IN_USE: "two active sets of credentials, grace period is over but the oldest set may still be in use",
+    ROTATION_DEFERRED: "credentials are old and will be rotated in a later wave",
 
     # bad states
     USER_NOT_FOUND: "user not found",
+    LOOKUP_FAILED: "credentials couldn't be listed, see 'error'",
+    STALE_PLAN: "credentials have changed since the plan was made, re-plan",
     MANY_CREDENTIALS: "more than 2 sets of credentials exist (program error)",
     UNKNOWN: "credentials are in an unhandled state (program error)"
 }
@@ -80,34 +99,183 @@ def coerce_key(kp):
         '-obj': kp,
     }
 
+_LOCAL = threading.local()
+
+def iam_resource():
+    "an IAM resource kept warm for the life of the process. resources aren't thread safe so each thread gets its own."
+    if not hasattr(_LOCAL, 'iam'):
+        _LOCAL.iam = boto3.session.Session().resource('iam')
+    return _LOCAL.iam
+
 def _get_user(iam_username):
     try:
-        iam = boto3.resource('iam')
+        iam = iam_resource()
         iamuser = iam.User(iam_username)
         iamuser.load()
         return iamuser
     except Exception as err:
-        print('warning: %s' % str(err))
+        LOG.warning(str(err), extra={'user': iam_username, 'phase': 'lookup'})
         return None
 
+@lru_cache(maxsize=None)
+def iam_client():
+    "clients, unlike resources, are thread safe"
+    return boto3.client('iam')
+
 def key_list(iam_username):
     _user = _get_user(iam_username)
     return lmap(coerce_key, _user.access_keys.all()) if _user else None
 
+def list_usernames():
+    "the username of every IAM user in the account, paging through ListUsers once"
+    paginator = iam_client().get_paginator('list_users')
+    return {user['UserName'] for page in paginator.paginate() for user in page['Users']}
+
+def _list_access_keys(iam_username):
+    paginator = iam_client().get_paginator('list_access_keys')
+    return [{'access_key_id': key['AccessKeyId'], 'create_date': key['CreateDate'], 'status': key['Status']}
+            for page in paginator.paginate(UserName=iam_username) for key in page['AccessKeyMetadata']]
+
+def _error_code(err):
+    "the AWS error code of a botocore `ClientError`, for example 'NoSuchEntity'"
+    return getattr(err, 'response', {}).get('Error', {}).get('Code')
+
+def _prefetch_access_keys(iam_username):
+    "the user's key list, None if the user no longer exists or the error if their keys couldn't be listed"
+    try:
+        return _list_access_keys(iam_username)
+    except Exception as err:
+        if _error_code(err) == 'NoSuchEntity':
+            # deleted since the users were listed
+            return None
+        LOG.warning(str(err), extra={'user': iam_username, 'phase': 'lookup'})
+        return err
+
+def prefetch(iam_username_list=None, workers=WORKERS, existing=None):
+    """returns a map of iam-username => key list for each of the given users that exist, or every user if none given.
+    users that don't exist, or aren't in `existing` if given, are absent from the map. their keys are listed concurrently.
+    a user whose keys couldn't be listed maps to the exception raised, so only that user fails."""
+    existing = list_usernames() if existing is None else existing
+    if iam_username_list is None:
+        iam_username_list = sorted(existing)
+    present = [iam_username for iam_username in dict.fromkeys(iam_username_list) if iam_username in existing]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        key_index = dict(zip(present, pool.map(_prefetch_access_keys, present)))
+    return {iam_username: keys for iam_username, keys in key_index.items() if keys is not None}
+
 def get_key(iam_username, key_id):
-    keys = lfilter(lambda kp: kp['access_key_id'] == key_id, key_list(iam_username))
+    "the given key of the given user, or None if either no longer exist"
+    try:
+        keys = lfilter(lambda kp: kp['access_key_id'] == key_id, _list_access_keys(iam_username))
+    except Exception as err:
+        LOG.warning(str(err), extra={'user': iam_username, 'phase': 'execute'})
+        return None
     if len(keys) == 1:
         return keys[0]
 
-def user_report(user_csvrow, max_key_age, grace_period_days):
-    "given a row, returns the same row with a list of action"
+def public_key(key):
+    "a key without any of its private '-' prefixed values"
+    return {k: v for k, v in key.items() if not k.startswith('-')}
+
+def _key_last_used(access_key_id):
+    resp = iam_client().get_access_key_last_used(AccessKeyId=access_key_id)['AccessKeyLastUsed']
+    # 'ServiceName' and 'Region' are 'N/A' and there is no 'LastUsedDate' if the key has never been used
+    return {
+        'last-used-date': resp.get('LastUsedDate'),
+        'last-used-service': resp.get('ServiceName'),
+        'last-used-region': resp.get('Region'),
+    }
+
+def key_last_used(access_key_id):
+    """when, where and with which service the given key was last used.
+    a failed lookup is recorded as a 'last-used-error' rather than looking like a key that has never been used."""
+    try:
+        return _key_last_used(access_key_id)
+    except Exception as err:
+        LOG.warning(str(err), extra={'key': access_key_id, 'phase': 'plan'})
+        return {'last-used-error': str(err)}
+
+def enrich_last_used(report_rows, workers=WORKERS):
+    """attaches the last-used date, service and region to each active key in the given user reports, looked up concurrently.
+    each key is looked up once per call and nothing is kept between calls, so a long-lived process never plans with
+    stale usage."""
+    active_keys = [key for row in report_rows for key in row.get('keys', []) if key['status'] != 'Inactive']
+    key_ids = list(dict.fromkeys(key['access_key_id'] for key in active_keys))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        last_used = dict(zip(key_ids, pool.map(key_last_used, key_ids)))
+    for key in active_keys:
+        key.update(last_used[key['access_key_id']])
+    return report_rows
+
+def hold_keys_in_use(user_report_data, hold_days):
+    """removes any 'disable' action on a key that has been used in the last `hold_days` days.
+    the key will be disabled on a later run once it is no longer in use.
+    a key whose last use couldn't be looked up is assumed to be in use."""
+    today = utcnow()
+    keys = {key['access_key_id']: key for key in user_report_data.get('keys', [])}
+
+    def in_use(action):
+        fnkey, key_id = action
+        if fnkey != 'disable':
+            return False
+        key = keys.get(key_id, {})
+        if 'last-used-error' in key:
+            return True
+        last_used = key.get('last-used-date')
+        return last_used is not None and (today - last_used).days < hold_days
+
+    held, actions = splitfilter(in_use, user_report_data['actions'])
+    if held:
+        user_report_data.update({
+            'state': KEY_IN_USE,
+            'reason': STATE_DESCRIPTIONS[KEY_IN_USE],
+            'actions': actions,
+            'held': [key_id for _, key_id in held],
+            'hold-if-used-within-days': hold_days,
+        })
+    return user_report_data
+
+def schedule_waves(report_rows, max_creates):
+    """caps the number of new credentials created per run at `max_creates` by spreading due rotations over several runs.
+    users without any credentials go first, then users furthest past their due date. ties are broken by a stable hash
+    of their username so the order doesn't change from one run to the next. each user due a rotation is given a `wave`,
+    those in wave 0 are rotated now and the rest are deferred. running daily, wave N is rotated in N days."""
+    ensure(max_creates > 0, "the maximum number of creates per run must be a positive number")
+    create = ('create', 'new')
+    due = [row for row in report_rows if create in row['actions']]
+
+    def priority(row):
+        # users without credentials have no working key to fall back on while they wait
+        return row.get('state') != NO_CREDENTIALS, -row.get('overdue-days', 0), stable_hash(row['iam-username'])
+    due = sorted(due, key=priority)
+    for i, row in enumerate(due):
+        wave = i // max_creates
+        row['wave'] = wave
+        if wave > 0:
+            row.update({
+                'state': ROTATION_DEFERRED,
+                'reason': STATE_DESCRIPTIONS[ROTATION_DEFERRED],
+                # inactive keys are still deleted
+                'actions': [action for action in row['actions'] if action != create],
+            })
+    return report_rows
+
+def user_report(user_csvrow, max_key_age, grace_period_days, key_index=None):
+    """given a row, returns the same row with a list of action.
+    keys are looked up in the `key_index` returned by `prefetch`, if given, otherwise they are fetched."""
     try:
         today = utcnow()
         state = UNKNOWN
         actions = []
 
-        access_keys = key_list(user_csvrow['iam-username'])
+        if key_index is not None:
+            access_keys = key_index.get(user_csvrow['iam-username'])
+        else:
+            access_keys = key_list(user_csvrow['iam-username'])
         ensure(access_keys is not None, USER_NOT_FOUND)
+        if isinstance(access_keys, Exception):
+            user_csvrow['error'] = str(access_keys)
+            ensure(False, LOOKUP_FAILED)
 
         #ensure(len(access_keys) > 0, NO_CREDENTIALS)
         ensure(len(access_keys) < 3, MANY_CREDENTIALS) # there must only ever be 0, 1 or 2 keys
@@ -153,6 +321,7 @@ def user_report(user_csvrow, max_key_age, grace_period_days):
             else:
                 # remaining key is too old
                 state = OLD_CREDENTIALS
+                user_csvrow['overdue-days'] = (today - active_key['create_date']).days - max_key_age
                 actions += [
                     ('create', 'new')
                 ]
@@ -164,6 +333,7 @@ def user_report(user_csvrow, max_key_age, grace_period_days):
             'state': state,
             'reason': STATE_DESCRIPTIONS[state],
             'actions': actions,
+            'keys': lmap(public_key, access_keys),
         })
         return user_csvrow
 
@@ -177,32 +347,30 @@ def user_report(user_csvrow, max_key_age, grace_period_days):
         })
         return user_csvrow
 
+# mutations go through `iam_client`, which is thread safe and kept warm for the life of the process.
+# the thread-local `iam_resource` would be rebuilt for each new execution thread.
+
 def delete_key(iam_username, key_id):
-    print('deleting key for', iam_username)
-    key = get_key(iam_username, key_id)
-    if key:
-        key['-obj'].delete()
-        return True
+    "deletes the key if the user still has it, see `delete_planned_key`"
+    if get_key(iam_username, key_id):
+        return delete_planned_key(iam_username, key_id)
     return False
 
 def disable_key(iam_username, key_id):
-    print('disabling key for', iam_username)
-    key = get_key(iam_username, key_id)
-    if key:
-        key['-obj'].deactivate()
-        return True
+    "disables the key if the user still has it, see `disable_planned_key`"
+    if get_key(iam_username, key_id):
+        return disable_planned_key(iam_username, key_id)
     return False
 
 def create_key(iam_username, _):
-    print('creating key for', iam_username)
-    iamuser = _get_user(iam_username)
-    key = iamuser.create_access_key_pair()
-    return {'aws-access-key': key.access_key_id,
-            'aws-secret-key': key.secret_access_key}
+    with logs.timed(LOG, 'created key', user=iam_username, phase='execute'):
+        key = iam_client().create_access_key(UserName=iam_username)['AccessKey']
+    return {'aws-access-key': key['AccessKeyId'],
+            'aws-secret-key': key['SecretAccessKey']}
 
-def execute_user_report(user_report_data):
+def execute_user_report(user_report_data, dispatch=None):
     ensure(isinstance(user_report_data, dict), "user-report must be a dict")
-    dispatch = {
+    dispatch = dispatch or {
         'delete': delete_key,
         'disable': disable_key,
         'create': create_key,
@@ -220,6 +388,70 @@ def execute_report(report_data):
     ensure(isinstance(report_data, list), "report data must be a list of user-report dicts")
     return lmap(execute_user_report, report_data)
 
+#
+# reviewed plans
+#
+
+def load_plan(plan_path):
+    "returns the passing user reports and the failing rows of a `*-report-*.json` plan file"
+    match = history.REPORT_RE.match(os.path.basename(plan_path))
+    ensure(match and match.group('type') == 'report', "not a plan, expecting a *-report-YYYY-MM-DD.json file: %s" % plan_path)
+    ensure(os.path.isfile(plan_path), "path not found: %s" % plan_path)
+    if match.group('date') != ymd(utcnow()):
+        LOG.warning("plan was made on %s" % match.group('date'), extra={'phase': 'execute', 'path': plan_path})
+    with open(plan_path, 'r') as fh:
+        plan = json.load(fh)
+    for row in plan['passes']:
+        ensure('keys' in row, "plan is too old to execute, it doesn't record the keys of %s" % row['iam-username'])
+        row['actions'] = [tuple(action) for action in row['actions']]
+    return plan['passes'], plan['fails']
+
+def _key_states(key_list_):
+    return sorted((key['access_key_id'], key['status']) for key in key_list_)
+
+def plan_is_current(user_report_data):
+    "True if the user's keys and their statuses are the same as when the plan was made"
+    iam_username = user_report_data['iam-username']
+    try:
+        live_keys = _list_access_keys(iam_username)
+    except Exception as err:
+        LOG.warning(str(err), extra={'user': iam_username, 'phase': 'execute'})
+        return False
+    return _key_states(user_report_data['keys']) == _key_states(live_keys)
+
+def delete_planned_key(iam_username, key_id):
+    "deletes a key known to exist, for example by `plan_is_current`, without looking the user and their keys up again"
+    with logs.timed(LOG, 'deleted key', user=iam_username, phase='execute', key=key_id):
+        iam_client().delete_access_key(UserName=iam_username, AccessKeyId=key_id)
+    return True
+
+def disable_planned_key(iam_username, key_id):
+    "disables a key known to exist, for example by `plan_is_current`, without looking the user and their keys up again"
+    with logs.timed(LOG, 'disabled key', user=iam_username, phase='execute', key=key_id):
+        iam_client().update_access_key(UserName=iam_username, AccessKeyId=key_id, Status='Inactive')
+    return True
+
+def execute_planned_user_report(user_report_data):
+    """executes the planned actions of a user only if their keys haven't changed since the plan was made.
+    the check is a single ListAccessKeys call made just before the user's first mutation. once it passes the planned
+    keys are mutated directly."""
+    if user_report_data['actions'] and not plan_is_current(user_report_data):
+        LOG.warning('skipping, ' + STATE_DESCRIPTIONS[STALE_PLAN], extra={'user': user_report_data['iam-username'], 'phase': 'execute'})
+        user_report_data.update({
+            'success?': False,
+            'state': STALE_PLAN,
+            'reason': STATE_DESCRIPTIONS[STALE_PLAN],
+            'planned-actions': user_report_data['actions'],
+            'actions': [],
+        })
+        return user_report_data
+    dispatch = {
+        'delete': delete_planned_key,
+        'disable': disable_planned_key,
+        'create': create_key,
+    }
+    return execute_user_report(user_report_data, dispatch)
+
 
 #
 # github gist
@@ -231,6 +463,7 @@ def gh_credentials():
         path = os.path.abspath(os.path.expanduser(path))
         return open(path, 'r').read().strip()
 
+@lru_cache(maxsize=None)
 def gh_user():
     "returns a user that can create gists"
     gh = Github(gh_credentials())
@@ -265,8 +498,8 @@ Your old credentials (if any) and this message will expire on {insert-expiry-dat
         'insert-secret-key': new_key['aws-secret-key'],
         'insert-expiry-date': ymd(utcnow() + timedelta(days=user_csvrow['grace-period-days'])),
     })
-    print('creating gist for', user_csvrow['name'])
-    gist = create_gist("new AWS API credentials", content)
+    with logs.timed(LOG, 'created gist', user=user_csvrow.get('iam-username'), phase='notify'):
+        gist = create_gist("new AWS API credentials", content)
     user_csvrow.update(gist)
     # nullify the secret key, we no longer need it
     user_csvrow['results']['create']['aws-secret-key'] = '[redacted]'
@@ -280,9 +513,13 @@ Your old credentials (if any) and this message will expire on {insert-expiry-dat
 EMAIL_FROM = 'it-admin@elifesciences.org' # verified SES address
 EMAIL_DEV_ADDR = 'tech-team@elifesciences.org'
 
-def send_email(to_addr, subject, content):
+@lru_cache(maxsize=None)
+def ses_client():
     # https://boto3.readthedocs.io/en/latest/reference/services/ses.html?highlight=ses#client
-    ses = boto3.client('ses', region_name='us-east-1')
+    return boto3.client('ses', region_name='us-east-1')
+
+def send_email(to_addr, subject, content):
+    ses = ses_client()
 
     # https://boto3.readthedocs.io/en/latest/reference/services/ses.html?highlight=ses#SES.Client.send_email
     kwargs = {
@@ -326,8 +563,8 @@ https://github.com/elifesciences/update-iam-human'''
         'todays-date': ymd(utcnow()),
         'author': current_user()
     })
-    print('sending email %r to %s (%s)' % (subject, user_csvrow['name'], to_addr))
-    result = send_email(to_addr, subject, content)
+    with logs.timed(LOG, 'sent email', user=user_csvrow.get('iam-username'), phase='notify', subject=subject):
+        result = send_email(to_addr, subject, content)
     user_csvrow.update({
         'disabled-email-id': result['MessageId'], # probably not at all useful
         'disabled-email-sent': utcnow(),
@@ -365,8 +602,8 @@ https://github.com/elifesciences/update-iam-human'''
         'todays-date': ymd(utcnow()),
         'author': current_user()
     })
-    print('sending email to %s (%s)' % (user_csvrow['name'], to_addr))
-    result = send_email(to_addr, subject, content)
+    with logs.timed(LOG, 'sent email', user=user_csvrow.get('iam-username'), phase='notify', subject=subject):
+        result = send_email(to_addr, subject, content)
     user_csvrow.update({
         'email-id': result['MessageId'], # probably not at all useful
         'email-sent': utcnow(),
@@ -380,57 +617,216 @@ https://github.com/elifesciences/update-iam-human'''
 # report wrangling
 #
 
-def notify(report_results):
-    "notifies users after executing actions in report"
+def _has_new_credentials(user_csvrow):
+    return 'create' in user_csvrow.get('results', {})
+
+def _redact(user_csvrow):
+    "removes any secrets from a row that failed before they were sent and removed"
+    new_key = user_csvrow.get('results', {}).get('create')
+    if new_key and 'aws-secret-key' in new_key:
+        new_key['aws-secret-key'] = '[redacted]'
+    if 'gist-html-url' in user_csvrow:
+        user_csvrow['gist-html-url'] = '[redacted]'
+    return user_csvrow
+
+def _failsafe(stage, phase):
+    """wraps a pipeline stage so an error is recorded on the user's row, and logged with the stage's `phase`, rather
+    than stopping the pipeline.
+    keys have already been created, and users emailed, for other users so their results must still be written.
+    rows that have already failed are passed through."""
+    @wraps(stage)
+    def wrapper(user_csvrow):
+        if not user_csvrow.get('success?', True):
+            return user_csvrow
+        try:
+            return stage(user_csvrow)
+        except Exception as err:
+            LOG.exception('%s failed' % stage.__name__, extra={'user': user_csvrow.get('iam-username'), 'phase': phase})
+            user_csvrow.update({
+                'success?': False,
+                'error': str(err),
+                'failed-step': stage.__name__,
+            })
+            return _redact(user_csvrow)
+    return wrapper
+
+def _gist_stage(user_csvrow):
+    return gh_create_user_gist(user_csvrow) if _has_new_credentials(user_csvrow) else user_csvrow
+
+def _email_stage(user_csvrow):
     # TODO: should user be notified if credentials have been disabled after a grace period?
-    # create a gist for those users with new credentials
-    users_w_new_credentials, unnotified = splitfilter(lambda row: 'create' in row['results'], report_results)
-    users_w_gists = lmap(gh_create_user_gist, users_w_new_credentials)
-    results = lmap(email_user__new_credentials, users_w_gists)
-    return {'notified': results, 'unnotified': unnotified}
+    return email_user__new_credentials(user_csvrow) if _has_new_credentials(user_csvrow) else user_csvrow
+
+def execute_and_notify(report_data, execute_fn=execute_user_report, queue_size=pipeline.QUEUE_SIZE):
+    """executes each user report with `execute_fn` then, if new credentials were created, creates their gist and emails them.
+    each user moves through each step as soon as they are done with the previous one, rather than waiting for every other
+    user, so new secret keys are held in memory only briefly and the first users are notified first.
+    a user whose step fails is marked as failed and doesn't go through the remaining steps, other users carry on.
+    returns the executed reports, which must be split into failed, notified and unnotified."""
+    ensure(isinstance(report_data, list), "report data must be a list of user-report dicts")
+    stages = [_failsafe(execute_fn, 'execute'), _failsafe(_gist_stage, 'notify'), _failsafe(_email_stage, 'notify')]
+    return pipeline.run(report_data, stages, queue_size)
 
-def write_report(user_csvpath, passes, fails, executed):
+def split_notified(report_results):
+    users_w_new_credentials, unnotified = splitfilter(_has_new_credentials, report_results)
+    return {'notified': users_w_new_credentials, 'unnotified': unnotified}
+
+def write_report(user_csvpath, passes, fails, executed, estimate=None, history_dir=history.HISTORY_DIR):
+    "writes the report to the current directory and appends it to the history in `history_dir`, if given"
     report = {'passes': passes, 'fails': fails}
+    if estimate:
+        report['estimate'] = estimate
     type_of_content = 'results' if executed else 'report'
+    date = ymd(utcnow())
     path = os.path.splitext(os.path.basename(user_csvpath))[0]
-    path = '%s-%s-%s.json' % (path, type_of_content, ymd(utcnow())) # "humans-results-2019-01-01.json"
+    path = '%s-%s-%s.json' % (path, type_of_content, date) # "humans-results-2019-01-01.json"
     data = utils.lossy_json_dumps(report, indent=4)
-    print(data)
+    LOG.debug(data, extra={'phase': 'write-report'})
     with open(path, 'w') as fh:
         fh.write(data)
+    if history_dir:
+        history.append(path, report, date, executed, history_dir)
     return path
 
-def main(user_csvpath, max_key_age=MAX_KEY_AGE_DAYS, grace_period_days=GRACE_PERIOD_DAYS, execute=False):
-    csv_contents = read_input(user_csvpath)
+def log_profile(profiler):
+    for phase in profiler.phases:
+        LOG.info('profiled phase', extra=dict(phase, duration=phase['wall-time']))
+
+def main(user_csvpath, profile=False, profile_dir=None, shard=None, **kwargs):
+    """reads, validates and processes the given csv file. see `process` for the remaining options.
+    `shard` is a (K, N) pair, only rows belonging to the Kth of N shards are processed"""
+    profiler = profiling.Profiler(enabled=profile or bool(profile_dir), stats_dir=profile_dir)
+    try:
+        with profiler.phase('read-input'):
+            csv_contents = read_input(user_csvpath)
+            if shard:
+                csv_contents = sharding.select(csv_contents, shard)
+                user_csvpath = sharding.shard_csvpath(user_csvpath, shard)
+        return process(csv_contents, user_csvpath, profiler=profiler, **kwargs)
+    finally:
+        log_profile(profiler)
+
+def execute_plan(plan_path, profile=False, profile_dir=None, history_dir=history.HISTORY_DIR):
+    """executes the actions in a reviewed plan file without planning again.
+    users whose keys have changed since the plan was made are skipped and reported as failures."""
+    profiler = profiling.Profiler(enabled=profile or bool(profile_dir), stats_dir=profile_dir)
+    try:
+        with profiler.phase('read-input'):
+            pass_rows, fail_rows = load_plan(plan_path)
+        cost = estimate.estimate(pass_rows, planned=True)
+        LOG.info('estimated cost of execution', extra={'phase': 'execute', 'total-calls': cost['total-calls'],
+                                                       'duration': cost['projected-seconds']['total']})
+        LOG.info('executing plan for %s users ...' % len(pass_rows), extra={'phase': 'execute', 'path': plan_path})
+        with profiler.phase('execute-and-notify'):
+            results = execute_and_notify(pass_rows, execute_planned_user_report)
+            results, failed_rows = splitfilter(lambda row: row['success?'], results)
+            results = split_notified(results)
+        with profiler.phase('write-report'):
+            # "humans-report-2019-01-01.json" => "humans.csv" => "humans-results-2019-01-02.json"
+            filename = os.path.basename(plan_path)
+            user_csvpath = filename[:history.REPORT_RE.match(filename).start('type') - 1] + '.csv'
+            path = write_report(user_csvpath, results, failed_rows + fail_rows, True, history_dir=history_dir)
+        LOG.info('wrote: %s' % path, extra={'phase': 'write-report', 'path': path})
+        # stale and failed users
+        return len(failed_rows)
+    finally:
+        log_profile(profiler)
+
+def plan(rows, max_key_age=MAX_KEY_AGE_DAYS, grace_period_days=GRACE_PERIOD_DAYS, last_used=True, hold_if_used_within=None,
+         workers=WORKERS, prefetch_keys=True, max_creates_per_run=None):
+    """plans the given validated input rows, returning the passing and failing user reports and the average latency of
+    the IAM calls made while planning. rows are updated in place.
+    unless `last_used` is False, each active key is annotated with when it was last used.
+    if `hold_if_used_within` is set, keys used within that many days are not disabled.
+    with `prefetch_keys` every user in the account is listed once and keys are listed only for those that exist,
+    otherwise each user is looked up individually. prefetching is cheaper for all but a handful of users.
+    if `max_creates_per_run` is set, no more than that many users have new credentials created, see `schedule_waves`."""
+    ensure(last_used or hold_if_used_within is None, "holding keys in use requires looking up when keys were last used")
     max_key_age, grace_period_days = lmap(int, [max_key_age, grace_period_days])
-    print('querying %s users ...' % len(csv_contents))
-    results = [user_report(row, max_key_age, grace_period_days) for row in csv_contents]
+    if prefetch_keys:
+        # ListUsers pages are fetched one after another so they aren't used to measure latency
+        existing = list_usernames()
+        start = time.perf_counter()
+        key_index = prefetch([row['iam-username'] for row in rows], int(workers), existing)
+        planning_seconds = time.perf_counter() - start
+        # ListAccessKeys per user, no more at once than there are users
+        planning_calls, planning_concurrency = len(key_index), min(int(workers), len(key_index)) or 1
+        results = [user_report(row, max_key_age, grace_period_days, key_index) for row in rows]
+    else:
+        key_index = None
+        start = time.perf_counter()
+        results = [user_report(row, max_key_age, grace_period_days, key_index) for row in rows]
+        planning_seconds = time.perf_counter() - start
+        # GetUser, ListAccessKeys per user
+        planning_calls, planning_concurrency = 2 * len(rows), 1
     pass_rows, fail_rows = splitfilter(lambda row: row['success?'], results)
+    if last_used:
+        enrich_last_used(pass_rows, int(workers))
+    if hold_if_used_within is not None:
+        [hold_keys_in_use(row, int(hold_if_used_within)) for row in pass_rows]
+    if max_creates_per_run is not None:
+        schedule_waves(pass_rows, int(max_creates_per_run))
+    return pass_rows, fail_rows, estimate.planning_latency(planning_calls, planning_seconds, planning_concurrency)
+
+def process(rows, user_csvpath, execute=False, profiler=None, history_dir=history.HISTORY_DIR, **kwargs):
+    """plans, and optionally executes and notifies, the given validated input rows. see `plan` for the planning options.
+    `user_csvpath` is used to name the report. rows are updated in place.
+    reports are appended to the history in `history_dir` unless it is None."""
+    profiler = profiler or profiling.Profiler()
+    LOG.info('querying %s users ...' % len(rows), extra={'phase': 'plan'})
+    with profiler.phase('plan'):
+        pass_rows, fail_rows, iam_latency = plan(rows, **kwargs)
 
     if not pass_rows:
         # nothing to do
         return len(fail_rows)
 
+    failed_rows = []
     if execute:
-        results = execute_report(pass_rows)
-        results = notify(results)
-        print('wrote: ', write_report(user_csvpath, results, fail_rows, execute))
+        with profiler.phase('execute-and-notify'):
+            results, failed_rows = splitfilter(lambda row: row['success?'], execute_and_notify(pass_rows))
+            results = split_notified(results)
+        with profiler.phase('write-report'):
+            path = write_report(user_csvpath, results, failed_rows + fail_rows, execute, history_dir=history_dir)
     else:
-        print('wrote: ', write_report(user_csvpath, pass_rows, fail_rows, execute))
+        cost = estimate.estimate(pass_rows, iam_latency)
+        LOG.info('estimated cost of execution', extra={'phase': 'plan', 'total-calls': cost['total-calls'],
+                                                       'duration': cost['projected-seconds']['total']})
+        with profiler.phase('write-report'):
+            path = write_report(user_csvpath, pass_rows, fail_rows, execute, cost, history_dir)
+    LOG.info('wrote: %s' % path, extra={'phase': 'write-report', 'path': path})
 
-    return 0
+    return len(failed_rows)
 
 if __name__ == '__main__':
     try:
-        ensure(gh_credentials(), "no github credentials found.")
         parser = argparse.ArgumentParser()
-        parser.add_argument('user_csvpath')
+        parser.add_argument('user_csvpath', nargs='?')
+        parser.add_argument('--execute-plan', default=None, metavar='PLAN', help="execute the actions in a reviewed *-report-*.json file instead of planning again")
         parser.add_argument('--execute', default=False, action='store_true')
         parser.add_argument('--max-key-age', default=MAX_KEY_AGE_DAYS)
         parser.add_argument('--grace-period-days', default=GRACE_PERIOD_DAYS)
-        kwargs = parser.parse_args().__dict__ # {'user_csvpath': 'example.csv', 'execute': False, 'max_key_age': 180, 'grace_period_days': 7}
+        parser.add_argument('--profile', default=False, action='store_true', help="report wall time, cpu time and memory per phase")
+        parser.add_argument('--profile-dir', default=None, help="also dump cProfile stats per phase to this directory. implies --profile")
+        parser.add_argument('--shard', default=None, type=sharding.parse_shard, help="K/N, only process the users in the Kth of N shards")
+        parser.add_argument('--skip-last-used', dest='last_used', default=True, action='store_false', help="don't look up when each active key was last used")
+        parser.add_argument('--hold-if-used-within', default=None, type=int, metavar='DAYS', help="don't disable keys used within this many days")
+        parser.add_argument('--workers', default=WORKERS, type=int, help="number of concurrent lookups")
+        parser.add_argument('--max-creates-per-run', default=None, type=int, metavar='N', help="rotate at most N users, spreading the rest over later runs")
+        parser.add_argument('--no-prefetch', dest='prefetch_keys', default=True, action='store_false', help="look each user up individually instead of listing every user once")
+        parser.add_argument('--history-dir', default=history.HISTORY_DIR, help="directory of the report history")
+        parser.add_argument('--no-history', dest='history_dir', action='store_const', const=None, help="don't append reports to the history")
+        logs.add_arguments(parser)
+        kwargs = parser.parse_args().__dict__ # {'user_csvpath': 'example.csv', 'execute': False, 'max_key_age': 180, 'grace_period_days': 7, ...}
+        logs.configure(kwargs.pop('log_level'))
+        ensure(gh_credentials(), "no github credentials found.")
+        plan_path = kwargs.pop('execute_plan')
+        if plan_path:
+            ensure(not kwargs['user_csvpath'], "--execute-plan doesn't take a csv file, the plan is executed as-is")
+            sys.exit(execute_plan(plan_path, kwargs['profile'], kwargs['profile_dir'], kwargs['history_dir']))
+        ensure(kwargs['user_csvpath'], "a csv file or --execute-plan is required")
         sys.exit(main(**kwargs))
     except AssertionError as err:
-        print('err:', err)
+        LOG.error('err: %s' % err)
         retcode = getattr(err, 'retcode', 1)
         sys.exit(retcode)
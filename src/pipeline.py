@@ -0,0 +1,54 @@
+"""runs items through a series of stages. each stage has its own thread and stages are connected by bounded queues,
+so an item moves on to the next stage as soon as it is done with the current one and slow stages hold back fast ones."""
+
+import queue
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+
+# maximum number of items waiting between two stages
+QUEUE_SIZE = 5
+
+_DONE = object()
+
+def _stage(fn, in_queue, out_queue, errors):
+    while True:
+        item = in_queue.get()
+        if item is _DONE:
+            out_queue.put(_DONE)
+            return
+        try:
+            out_queue.put(fn(item))
+        except Exception as err:
+            # the item is dropped but items already in later stages carry on
+            LOG.exception("stage %s failed" % getattr(fn, '__name__', fn))
+            errors.append(err)
+
+def run(items, stages, queue_size=QUEUE_SIZE):
+    """passes each item through each of the `stages` functions in turn, returning the results in the order they completed.
+    if a stage raises an exception no new items are started, items already started are finished, and the first
+    exception is re-raised."""
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages] + [queue.Queue()]
+    errors = []
+    threads = [threading.Thread(target=_stage, args=(fn, queues[i], queues[i + 1], errors), daemon=True)
+               for i, fn in enumerate(stages)]
+    [thread.start() for thread in threads]
+
+    for item in items:
+        if errors:
+            break
+        queues[0].put(item) # blocks while the first stage is busy
+    queues[0].put(_DONE)
+
+    results = []
+    while True:
+        result = queues[-1].get()
+        if result is _DONE:
+            break
+        results.append(result)
+    [thread.join() for thread in threads]
+
+    if errors:
+        raise errors[0]
+    return results
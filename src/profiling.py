@@ -0,0 +1,76 @@
+"per-phase wall time, cpu time and memory profiling. enabled with `--profile`"
+
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from .utils import ensure
+
+TOP_ALLOCATIONS = 5
+
+# from python 3.12 cProfile uses `sys.monitoring` and a single profile sees every thread.
+# before that a profile only sees the thread that enabled it.
+PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+
+def _thread_profiler(profiles):
+    "a `threading.setprofile` hook that gives each thread started from now on its own profile, added to `profiles`"
+    def hook(frame, event, arg):
+        profile = cProfile.Profile()
+        profiles.append(profile)
+        # replaces this hook for the rest of the thread
+        profile.enable()
+    return hook
+
+class Profiler:
+    """records the wall time, cpu time and tracemalloc peak of each named phase.
+    when `stats_dir` is given, cProfile stats for each phase are dumped to `$stats_dir/$phase.prof`.
+    the stats include threads started during the phase, such as the workers of a pool or the stages of a pipeline.
+    a disabled profiler does nothing and costs nothing."""
+
+    def __init__(self, enabled=False, stats_dir=None):
+        self.enabled = enabled
+        self.stats_dir = stats_dir
+        self.phases = []
+        if enabled and stats_dir:
+            os.makedirs(stats_dir, exist_ok=True)
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        # tracemalloc peaks are global, nested phases would report their parent's peak
+        ensure(not tracemalloc.is_tracing(), "profiling phases cannot be nested: %s" % name)
+        profiles = [cProfile.Profile()] if self.stats_dir else []
+        tracemalloc.start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if profiles:
+            profiles[0].enable()
+            if not PROFILES_ALL_THREADS:
+                threading.setprofile(_thread_profiler(profiles))
+        try:
+            yield
+        finally:
+            if profiles:
+                threading.setprofile(None)
+                profiles[0].disable()
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+            top = snapshot.statistics('lineno')[:TOP_ALLOCATIONS]
+            self.phases.append({
+                'phase': name,
+                'wall-time': round(wall, 6),
+                'cpu-time': round(cpu, 6),
+                'memory-peak': peak,
+                'top-allocations': [{'location': str(stat.traceback[0]), 'size': stat.size, 'count': stat.count} for stat in top],
+            })
+            if profiles:
+                pstats.Stats(*profiles).dump_stats(os.path.join(self.stats_dir, '%s.prof' % name))
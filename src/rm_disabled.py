@@ -1,35 +1,23 @@
 '''
 some very rough code for deleting inactive credentials in bulk.
 
-read the code before executing it, then do: $ python -m src.rm_inactive
+read the code before executing it, then do: $ python -m src.rm_disabled
 '''
 
-import boto3
-from . import utils
-from .main import key_list
-import json
-import os
+from . import logs
+from .main import prefetch, iam_client
 import itertools
+import logging
+
+LOG = logging.getLogger(__name__)
 
 def shallow_flatten(x):
     return list(itertools.chain(*x))
 
-def get_all_users():
-    if os.path.exists('cache.json'):
-        return json.load(open('cache.json', 'r'))
-    try:
-        iam = boto3.client('iam')
-        paginator = iam.get_paginator('list_users')
-        resp = list(paginator.paginate())
-        open('cache.json', 'w').write(utils.lossy_json_dumps(resp))
-        return resp
-    except Exception as err:
-        print('warning: %s' % str(err))
-        return None
-
-def list_keys(user):
-    print('fetching keys for', user['UserName'])
-    return key_list(user['UserName'])
+def user_keys(key_index):
+    "{iam-username: [key, ...]} => [key, ...], each key with its 'iam-username'. users whose keys couldn't be listed are skipped"
+    return shallow_flatten([dict(key, **{'iam-username': iam_username}) for key in keys]
+                           for iam_username, keys in key_index.items() if not isinstance(keys, Exception))
 
 def filter_inactive(key_list):
     return filter(lambda key: key['status'] == 'Inactive', key_list)
@@ -39,16 +27,17 @@ def pp(x):
     pprint.pprint(x)
 
 def delete_key(key):
-    print('deleting key', key)
-    key['-obj'].delete()
+    LOG.info('deleting key', extra={'user': key['iam-username'], 'key': key['access_key_id']})
+    iam_client().delete_access_key(UserName=key['iam-username'], AccessKeyId=key['access_key_id'])
 
 def main():
-    resp = get_all_users()
-    user_list = resp[0]['Users']
-    inactive_key_list = list(filter_inactive(shallow_flatten(map(list_keys, user_list))))
+    # every user is listed once and their keys are listed concurrently
+    key_index = prefetch()
+    inactive_key_list = list(filter_inactive(user_keys(key_index)))
     pp(inactive_key_list)
     input('delete these %s inactive keys?' % len(inactive_key_list))
     list(map(delete_key, inactive_key_list))
 
 if __name__ == '__main__':
+    logs.configure()
     main()
@@ -0,0 +1,127 @@
+"""splits a humans csv file across several nodes and merges their reports back together.
+
+rows are assigned to shards by a stable hash of their `iam-username` so every node agrees on who does what:
+
+    node1 $ ./update-iam.sh humans.csv --execute --shard 1/3
+    node2 $ ./update-iam.sh humans.csv --execute --shard 2/3
+    node3 $ ./update-iam.sh humans.csv --execute --shard 3/3
+
+each node writes a `humans-shard-K-of-N-results-DATE.json` file. gather them and merge them with:
+
+    $ python -m src.shard humans-shard-*-results-2019-01-01.json
+"""
+
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+from . import logs, estimate, history, utils
+from .utils import ensure, stable_hash
+
+LOG = logging.getLogger(__name__)
+
+SHARD_REPORT_RE = re.compile(r'^(?P<name>.+)-shard-(?P<k>\d+)-of-(?P<n>\d+)-(?P<type>report|results)-(?P<date>\d{4}-\d{2}-\d{2})\.json$')
+
+def parse_shard(string):
+    "'2/4' => (2, 4). shards are numbered from 1. used as an argparse `type` so bad values raise an `ArgumentTypeError`"
+    match = re.match(r'^(\d+)/(\d+)$', string or '')
+    if not match:
+        raise argparse.ArgumentTypeError("shard must look like K/N, for example 1/4: %r" % string)
+    k, n = int(match.group(1)), int(match.group(2))
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError("shard K/N must have 1 <= K <= N: %r" % string)
+    return k, n
+
+def shard_of(iam_username, num_shards):
+    "the shard, from 1 to `num_shards`, the given user belongs to"
+    return stable_hash(iam_username) % num_shards + 1
+
+def select(rows, shard):
+    "the subset of rows belonging to the given (K, N) shard"
+    k, n = shard
+    return [row for row in rows if shard_of(row['iam-username'], n) == k]
+
+def shard_csvpath(user_csvpath, shard):
+    "'/path/to/humans.csv' => '/path/to/humans-shard-1-of-4.csv', used to name the shard's report"
+    path, ext = os.path.splitext(user_csvpath)
+    return '%s-shard-%s-of-%s%s' % (path, shard[0], shard[1], ext)
+
+#
+# merging
+#
+
+def _run_of(match):
+    "shard reports from the same run share a name, type and number of shards"
+    return match['name'], match['type'], int(match['n'])
+
+def _merge_passes(passes_list):
+    if all(isinstance(passes, list) for passes in passes_list):
+        # report
+        return [row for passes in passes_list for row in passes]
+    # results, {'notified': [...], 'unnotified': [...]}
+    ensure(all(isinstance(passes, dict) for passes in passes_list), "can't merge reports with results")
+    merged = {}
+    for passes in passes_list:
+        for key, rows in passes.items():
+            merged.setdefault(key, []).extend(rows)
+    return merged
+
+def merge(paths, output_dir='.', history_dir=history.HISTORY_DIR):
+    """merges the per-shard reports at `paths` into the single report `main.write_report` would have written.
+    the merged report is appended to the history in `history_dir`, if given. returns the path to the merged report."""
+    ensure(paths, "no shard reports to merge")
+    matches = []
+    for path in paths:
+        match = SHARD_REPORT_RE.match(os.path.basename(path))
+        ensure(match, "not a shard report: %s" % path)
+        matches.append(match.groupdict())
+
+    name, type_of_content, num_shards = _run_of(matches[0])
+    for match in matches:
+        ensure(_run_of(match) == (name, type_of_content, num_shards),
+               "shard reports are from different runs: %s" % ', '.join(paths))
+    shard_nums = sorted(int(match['k']) for match in matches)
+    ensure(len(set(shard_nums)) == len(shard_nums), "the same shard was given more than once: %s" % shard_nums)
+    missing = sorted(set(range(1, num_shards + 1)) - set(shard_nums))
+    if missing:
+        # a shard with nothing to do doesn't write a report
+        LOG.warning("missing shards %s of %s" % (missing, num_shards), extra={'phase': 'merge'})
+
+    reports = []
+    for _, path in sorted(zip([int(match['k']) for match in matches], paths)):
+        with open(path, 'r') as fh:
+            reports.append(json.load(fh))
+
+    merged = {
+        'passes': _merge_passes([report['passes'] for report in reports]),
+        'fails': [row for report in reports for row in report['fails']],
+    }
+    estimates = [report['estimate'] for report in reports if 'estimate' in report]
+    if estimates:
+        merged['estimate'] = estimate.merge(estimates)
+
+    date = max(match['date'] for match in matches)
+    path = os.path.join(output_dir, '%s-%s-%s.json' % (name, type_of_content, date)) # "humans-results-2019-01-01.json"
+    with open(path, 'w') as fh:
+        fh.write(utils.lossy_json_dumps(merged, indent=4))
+    if history_dir:
+        history.append(path, merged, date, type_of_content == 'results', history_dir)
+    LOG.info('wrote: %s' % path, extra={'phase': 'merge', 'path': path})
+    return path
+
+if __name__ == '__main__':
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('paths', nargs='+', help="the *-shard-K-of-N-report-*.json or *-shard-K-of-N-results-*.json files to merge")
+        parser.add_argument('--output-dir', default='.')
+        parser.add_argument('--history-dir', default=history.HISTORY_DIR, help="directory of the report history")
+        parser.add_argument('--no-history', dest='history_dir', action='store_const', const=None, help="don't append the merged report to the history")
+        logs.add_arguments(parser)
+        kwargs = parser.parse_args().__dict__
+        logs.configure(kwargs.pop('log_level'))
+        merge(**kwargs)
+    except AssertionError as err:
+        LOG.error('err: %s' % err)
+        sys.exit(getattr(err, 'retcode', 1))
@@ -0,0 +1,217 @@
+"""forecasts rotation load over many days.
+
+runs the real `main.plan` and `main.execute_report` each simulated day against an in-memory stand-in for IAM
+populated with synthetic users, counting the creates, disables, deletes, emails, gists and API calls made each day.
+synthetic users use their active keys every day.
+
+    $ python -m src.simulate --users 5000 --days 365 --max-key-age 180 --grace-period-days 7
+"""
+
+import random
+import argparse
+import threading
+from datetime import timedelta
+from collections import Counter
+from contextlib import contextmanager
+from . import main, logs, utils
+from .utils import ensure, utcnow
+
+class FakeKey:
+    "an access key"
+
+    def __init__(self, iam, iam_username, access_key_id, create_date, status='Active'):
+        self.iam = iam
+        self.iam_username = iam_username
+        self.access_key_id = access_key_id
+        self.create_date = create_date
+        self.status = status
+
+class FakeAccessKeys:
+    def __init__(self, iam, iam_username):
+        self.iam = iam
+        self.iam_username = iam_username
+
+    def all(self):
+        self.iam.count('ListAccessKeys')
+        return list(self.iam.users[self.iam_username])
+
+class FakeUser:
+    def __init__(self, iam, iam_username):
+        self.iam = iam
+        self.name = iam_username
+        self.access_keys = FakeAccessKeys(iam, iam_username)
+
+    def load(self):
+        self.iam.count('GetUser')
+        ensure(self.name in self.iam.users, "NoSuchEntity: The user with name %s cannot be found." % self.name)
+
+class FakePaginator:
+    def __init__(self, pages_fn):
+        self.pages_fn = pages_fn
+
+    def paginate(self, **kwargs):
+        return self.pages_fn(**kwargs)
+
+class FakeIAMClient:
+    "the subset of the boto3 IAM client used by `main`"
+
+    # ListUsers returns at most 100 users per call
+    PAGE_SIZE = 100
+
+    def __init__(self, iam):
+        self.iam = iam
+
+    def get_paginator(self, operation_name):
+        return FakePaginator(getattr(self, '_paginate_' + operation_name))
+
+    def _paginate_list_users(self):
+        usernames = list(self.iam.users)
+        for i in range(0, max(len(usernames), 1), self.PAGE_SIZE):
+            self.iam.count('ListUsers')
+            yield {'Users': [{'UserName': iam_username} for iam_username in usernames[i:i + self.PAGE_SIZE]]}
+
+    def _paginate_list_access_keys(self, UserName):
+        self.iam.count('ListAccessKeys')
+        yield {'AccessKeyMetadata': [{'AccessKeyId': key.access_key_id, 'CreateDate': key.create_date, 'Status': key.status}
+                                     for key in self.iam.users[UserName]]}
+
+    def _key(self, UserName, AccessKeyId):
+        return next(key for key in self.iam.users[UserName] if key.access_key_id == AccessKeyId)
+
+    def delete_access_key(self, UserName, AccessKeyId):
+        self.iam.count('DeleteAccessKey')
+        self.iam.users[UserName].remove(self._key(UserName, AccessKeyId))
+
+    def update_access_key(self, UserName, AccessKeyId, Status):
+        self.iam.count('UpdateAccessKey')
+        self._key(UserName, AccessKeyId).status = Status
+
+    def create_access_key(self, UserName):
+        self.iam.count('CreateAccessKey')
+        key = self.iam.new_key(UserName, self.iam.today)
+        self.iam.users[UserName].append(key)
+        return {'AccessKey': {'AccessKeyId': key.access_key_id, 'SecretAccessKey': '[simulated]'}}
+
+    def get_access_key_last_used(self, AccessKeyId):
+        self.iam.count('GetAccessKeyLastUsed')
+        return {'AccessKeyLastUsed': {'LastUsedDate': self.iam.today, 'ServiceName': 's3', 'Region': 'us-east-1'}}
+
+class FakeIAM:
+    "the subset of the boto3 IAM resource used by `main`, with users and their keys held in memory"
+
+    def __init__(self, today):
+        self.today = today
+        self.users = {} # {iam-username: [FakeKey, ...]}
+        self.calls = Counter()
+        self.client = FakeIAMClient(self)
+        self._key_counter = 0
+        # planning calls IAM from several threads
+        self._lock = threading.Lock()
+
+    def count(self, operation_name):
+        with self._lock:
+            self.calls[operation_name] += 1
+
+    def new_key(self, iam_username, create_date, status='Active'):
+        self._key_counter += 1
+        return FakeKey(self, iam_username, 'AKIA-SIM-%d' % self._key_counter, create_date, status)
+
+    def add_user(self, iam_username, key_ages):
+        "adds a user with one active key per age in `key_ages` (days)"
+        self.users[iam_username] = [self.new_key(iam_username, self.today - timedelta(days=age)) for age in key_ages]
+
+    def User(self, iam_username):
+        return FakeUser(self, iam_username)
+
+@contextmanager
+def stand_in(iam):
+    "points `main` at the fake IAM and its clock for the duration of the block"
+    original = main.iam_resource, main.iam_client, main.utcnow
+    main.iam_resource, main.iam_client, main.utcnow = (lambda: iam), (lambda: iam.client), (lambda: iam.today)
+    try:
+        yield iam
+    finally:
+        main.iam_resource, main.iam_client, main.utcnow = original
+
+def synthetic_users(iam, count, max_initial_age, cluster_fraction=0.0, seed=None):
+    """populates `iam` with `count` users each with a single active key aged between 0 and `max_initial_age` days.
+    a `cluster_fraction` of the users share the same key age, as happens after a bulk onboarding or a previous storm."""
+    rand = random.Random(seed)
+    cluster_age = rand.randint(0, max_initial_age)
+    rows = []
+    for i in range(count):
+        iam_username = 'SimUser%05d' % i
+        age = cluster_age if rand.random() < cluster_fraction else rand.randint(0, max_initial_age)
+        iam.add_user(iam_username, [age])
+        rows.append({'name': iam_username, 'email': '%s@example.org' % iam_username.lower(), 'iam-username': iam_username})
+    return rows
+
+def simulate_day(iam, rows, max_key_age, grace_period_days, **kwargs):
+    """plans and executes a single day, returning that day's counts.
+    planning is done exactly as `main.process` does it, see `main.plan` for the `kwargs`."""
+    iam.calls.clear()
+    with stand_in(iam):
+        pass_rows, _, _ = main.plan([dict(row) for row in rows], max_key_age, grace_period_days, **kwargs)
+        results = main.execute_report(pass_rows)
+
+    executed = Counter(action for row in results for action in row['results'])
+    creates = executed['create']
+    return {
+        'date': utils.ymd(iam.today),
+        'creates': creates,
+        'deferred': sum(1 for row in results if row['state'] == main.ROTATION_DEFERRED),
+        'disables': executed['disable'],
+        'deletes': executed['delete'],
+        # `main.execute_and_notify` creates one gist and sends one email per user with new credentials
+        'gists': creates,
+        'emails': creates,
+        'iam-calls': dict(iam.calls),
+        'api-calls': sum(iam.calls.values()) + creates * 2,
+    }
+
+def simulate(users=1000, days=365, max_key_age=main.MAX_KEY_AGE_DAYS, grace_period_days=main.GRACE_PERIOD_DAYS,
+             max_initial_age=None, cluster_fraction=0.0, seed=None, max_creates_per_run=None, prefetch_keys=True, last_used=True):
+    max_key_age, grace_period_days = int(max_key_age), int(grace_period_days)
+    max_initial_age = int(max_initial_age) if max_initial_age is not None else max_key_age * 2
+    iam = FakeIAM(utcnow())
+    rows = synthetic_users(iam, int(users), max_initial_age, float(cluster_fraction), seed)
+
+    daily = []
+    for _ in range(int(days)):
+        daily.append(simulate_day(iam, rows, max_key_age, grace_period_days, max_creates_per_run=max_creates_per_run,
+                                  prefetch_keys=prefetch_keys, last_used=last_used))
+        iam.today += timedelta(days=1)
+
+    peak = max(daily, key=lambda day: day['api-calls'])
+    totals = Counter()
+    [totals.update({key: day[key] for key in ['creates', 'disables', 'deletes', 'gists', 'emails', 'api-calls']}) for day in daily]
+    return {
+        'users': len(rows),
+        'max-key-age': max_key_age,
+        'grace-period-days': grace_period_days,
+        'max-creates-per-run': max_creates_per_run,
+        'totals': dict(totals),
+        'peak-api-calls': peak['api-calls'],
+        'peak-date': peak['date'],
+        'peak-creates': max(day['creates'] for day in daily),
+        'peak-disables': max(day['disables'] for day in daily),
+        'peak-deferred': max(day['deferred'] for day in daily),
+        'daily': daily,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', default=1000, type=int)
+    parser.add_argument('--days', default=365, type=int)
+    parser.add_argument('--max-key-age', default=main.MAX_KEY_AGE_DAYS, type=int)
+    parser.add_argument('--grace-period-days', default=main.GRACE_PERIOD_DAYS, type=int)
+    parser.add_argument('--max-initial-age', default=None, type=int, help="oldest synthetic key in days. defaults to twice --max-key-age")
+    parser.add_argument('--cluster-fraction', default=0.0, type=float, help="fraction of users whose keys were all created on the same day")
+    parser.add_argument('--seed', default=None, type=int)
+    parser.add_argument('--max-creates-per-run', default=None, type=int, help="rotate at most this many users a day")
+    parser.add_argument('--no-prefetch', dest='prefetch_keys', default=True, action='store_false', help="look each user up individually instead of listing every user once")
+    parser.add_argument('--skip-last-used', dest='last_used', default=True, action='store_false', help="don't look up when each active key was last used")
+    parser.add_argument('--log-level', default='WARNING', type=str.upper, choices=logs.LEVELS)
+    kwargs = parser.parse_args().__dict__
+    logs.configure(kwargs.pop('log_level'))
+    print(utils.lossy_json_dumps(simulate(**kwargs), indent=4))
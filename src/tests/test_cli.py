@@ -0,0 +1,51 @@
+from unittest.mock import patch
+from src import cli
+
+def fake_process(rows, user_csvpath, **kwargs):
+    for row in rows:
+        row.update({'state': 'ideal', 'reason': '...'})
+    return 0
+
+def test_interactive_session():
+    "users are prompted for until a blank name is given, each is processed in turn without a csv file"
+    answers = iter([
+        'Foo Bar', 'foo@example.org', 'FooBar',
+        'Baz', 'not-an-email', 'Baz', # bad row, prompted again
+        'Baz', 'baz@example.org', 'Baz',
+        '',
+    ])
+    with patch('builtins.input', lambda _: next(answers)):
+        with patch('src.main.process', side_effect=fake_process) as mock:
+            cli.cli_main(interactive=True, max_key_age=0)
+
+    assert 2 == mock.call_count
+    first_call, second_call = mock.call_args_list
+    assert [{'name': 'Foo Bar', 'email': 'foo@example.org', 'iam-username': 'FooBar', 'state': 'ideal', 'reason': '...'}] == first_call.args[0]
+    assert 'cli-FooBar.csv' == first_call.args[1]
+    assert {'execute': False, 'prefetch_keys': False, 'max_key_age': 0} == first_call.kwargs
+    assert 'Baz' == second_call.args[0][0]['iam-username']
+
+def test_single_user():
+    answers = iter(['Foo Bar', 'foo@example.org', 'FooBar'])
+    with patch('builtins.input', lambda _: next(answers)):
+        with patch('src.main.process', side_effect=fake_process) as mock:
+            cli.cli_main(execute=True)
+    assert 1 == mock.call_count
+
+def test_interactive_session_survives_errors(capsys):
+    "an error rotating one user is reported and the next user is prompted for"
+    answers = iter([
+        'Foo Bar', 'foo@example.org', 'FooBar',
+        'Baz', 'baz@example.org', 'Baz',
+        '',
+    ])
+    def explode_once(rows, user_csvpath, **kwargs):
+        if rows[0]['iam-username'] == 'FooBar':
+            raise RuntimeError("github is down")
+        return fake_process(rows, user_csvpath, **kwargs)
+
+    with patch('builtins.input', lambda _: next(answers)):
+        with patch('src.main.process', side_effect=explode_once) as mock:
+            cli.cli_main(interactive=True)
+    assert 2 == mock.call_count
+    assert 'err: github is down' in capsys.readouterr().out
@@ -0,0 +1,59 @@
+import pytest
+from src import estimate
+
+def test_count_calls():
+    rows = [
+        {'actions': [('delete', 'AKIA-DUMMY1'), ('create', 'new')]},
+        {'actions': [('disable', 'AKIA-DUMMY2')]},
+        {'actions': []},
+    ]
+    calls = estimate.count_calls(rows)
+    expected = {
+        'iam': {'ListAccessKeys': 2, 'DeleteAccessKey': 1, 'CreateAccessKey': 1, 'UpdateAccessKey': 1},
+        'github': {'CreateGist': 1},
+        'ses': {'SendEmail': 1},
+    }
+    assert expected == calls
+
+def test_count_planned_calls():
+    "executing a plan file lists each user's keys once then mutates them directly"
+    rows = [
+        {'actions': [('delete', 'AKIA-DUMMY1'), ('create', 'new')]},
+        {'actions': [('disable', 'AKIA-DUMMY2')]},
+        {'actions': []},
+    ]
+    calls = estimate.count_calls(rows, planned=True)
+    expected = {
+        'iam': {'ListAccessKeys': 2, 'DeleteAccessKey': 1, 'CreateAccessKey': 1, 'UpdateAccessKey': 1},
+        'github': {'CreateGist': 1},
+        'ses': {'SendEmail': 1},
+    }
+    assert expected == calls
+
+def test_planning_latency():
+    assert 0.5 == estimate.planning_latency(10, 5.0)
+    assert 1.0 == estimate.planning_latency(10, 5.0, concurrency=2)
+    assert estimate.planning_latency(0, 0) is None
+
+def test_estimate():
+    rows = [{'actions': [('create', 'new')]}] * 10
+    rate_limits = {'iam': 1000, 'github': 1, 'ses': 1000}
+    result = estimate.estimate(rows, iam_latency=0.1, rate_limits=rate_limits)
+    assert 30 == result['total-calls']
+    # 10 iam calls at 0.1s each
+    assert 1.0 == result['projected-seconds']['iam']
+    # 10 gists are rate limited to one a second
+    assert 10.0 == result['projected-seconds']['github']
+    # stages overlap, the slowest stage determines the total
+    assert 10.0 == result['projected-seconds']['total']
+
+def test_estimate_concurrency():
+    rows = [{'actions': [('disable', 'AKIA-DUMMY')]}] * 10
+    rate_limits = {'iam': 1000, 'github': 1000, 'ses': 1000}
+    result = estimate.estimate(rows, iam_latency=0.1, concurrency=2, rate_limits=rate_limits)
+    # 20 iam calls at 0.1s each, two at a time
+    assert 1.0 == result['projected-seconds']['total']
+
+def test_estimate_unknown_action():
+    with pytest.raises(AssertionError):
+        estimate.estimate([{'actions': [('explode', 'new')]}])
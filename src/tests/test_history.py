@@ -0,0 +1,100 @@
+import os
+import json
+import pytest
+from unittest.mock import patch
+from datetime import timedelta
+from src import history, utils
+
+def report(*usernames, state='ideal'):
+    return {'passes': [{'iam-username': username, 'state': state, 'actions': []} for username in usernames], 'fails': []}
+
+def results(*usernames):
+    notified = [{'iam-username': username, 'results': {'create': {}}, 'email-sent': '2019-01-02T00:00:00'} for username in usernames]
+    return {'passes': {'notified': notified, 'unnotified': []}, 'fails': [{'iam-username': 'Missing', 'state': 'user-not-found'}]}
+
+def test_report_rows():
+    assert ['FooBar', 'Missing'] == [row['iam-username'] for row in history.report_rows(results('FooBar'))]
+
+def test_append_and_query(tmp_path):
+    history_dir = str(tmp_path / 'history')
+    assert 2 == history.append('humans-report-2019-01-01.json', report('FooBar', 'BarFoo'), '2019-01-01', False, history_dir)
+    history.append('humans-results-2019-01-02.json', results('FooBar'), '2019-01-02', True, history_dir)
+
+    timeline = history.query('FooBar', history_dir)
+    assert [('2019-01-01', 'report'), ('2019-01-02', 'results')] == [(entry['date'], entry['type']) for entry in timeline]
+    assert 'humans-results-2019-01-02.json' == timeline[1]['report']
+    assert '2019-01-02T00:00:00' == timeline[1]['row']['email-sent']
+
+    assert 1 == len(history.query('BarFoo', history_dir))
+    assert 1 == len(history.query('Missing', history_dir))
+    assert [] == history.query('Nobody', history_dir)
+
+def test_query_shard_duplicates(tmp_path):
+    "a row recorded by a shard's report and again by the merged report appears once"
+    history_dir = str(tmp_path)
+    history.append('humans-shard-1-of-2-report-2019-01-01.json', report('FooBar'), '2019-01-01', False, history_dir)
+    history.append('humans-shard-2-of-2-report-2019-01-01.json', report('BarFoo'), '2019-01-01', False, history_dir)
+    # merged reports are read back from the shard's json files
+    merged = json.loads(utils.lossy_json_dumps(report('FooBar', 'BarFoo')))
+    history.append('humans-report-2019-01-01.json', merged, '2019-01-01', False, history_dir)
+    for username in ['FooBar', 'BarFoo']:
+        assert ['humans-report-2019-01-01.json'] == [entry['report'] for entry in history.query(username, history_dir)]
+
+def test_query_same_day_runs(tmp_path):
+    "separate runs on the same day are all kept"
+    history_dir = str(tmp_path)
+    rotated = results('FooBar')
+    rotated['passes']['notified'][0]['results'] = {'create': {'aws-access-key': 'AKIA-DUMMY'}}
+    history.append('humans-results-2019-01-02.json', rotated, '2019-01-02', True, history_dir)
+    later = {'passes': {'notified': [], 'unnotified': [{'iam-username': 'FooBar', 'state': 'in-grace-period', 'results': {}}]}, 'fails': []}
+    history.append('humans-results-2019-01-02.json', later, '2019-01-02', True, history_dir)
+
+    expected = [('2019-01-02T00:00:00', None), (None, 'in-grace-period')]
+    timeline = history.query('FooBar', history_dir)
+    assert expected == [(entry['row'].get('email-sent'), entry['row'].get('state')) for entry in timeline]
+    assert 'create' in timeline[0]['row']['results']
+
+    assert 3 == history.compact(history_dir) # including 'Missing'
+    assert expected == [(entry['row'].get('email-sent'), entry['row'].get('state')) for entry in history.query('FooBar', history_dir)]
+
+def test_unsharded():
+    assert 'humans-results-2019-01-01.json' == history.unsharded('humans-shard-1-of-2-results-2019-01-01.json')
+    assert 'humans-report-2019-01-01.json' == history.unsharded('humans-report-2019-01-01.json')
+
+def test_import_report(tmp_path):
+    path = tmp_path / 'humans-results-2019-01-02.json'
+    path.write_text(json.dumps(results('FooBar')))
+    history_dir = str(tmp_path / 'history')
+    history.import_report(str(path), history_dir)
+    assert [('2019-01-02', 'results')] == [(entry['date'], entry['type']) for entry in history.query('FooBar', history_dir)]
+
+def test_compact(tmp_path):
+    history_dir = str(tmp_path / 'history')
+    today, long_ago = utils.ymd(utils.utcnow()), utils.ymd(utils.utcnow() - timedelta(days=1000))
+    history.append('humans-report-%s.json' % long_ago, report('FooBar'), long_ago, False, history_dir)
+    history.append('humans-report-%s.json' % today, report('FooBar'), today, False, history_dir)
+    history.append('humans-report-%s.json' % today, report('FooBar', 'BarFoo'), today, False, history_dir)
+    history.append('humans-shard-1-of-2-report-%s.json' % today, report('FooBar'), today, False, history_dir)
+    history.append('humans-report-%s.json' % today, report('FooBar'), today, False, history_dir)
+    size = os.path.getsize(os.path.join(history_dir, history.DATA_FILE % 0))
+
+    # only the shard's record is dropped, separate runs on the same day are kept
+    assert 5 == history.compact(history_dir)
+    assert 4 == history.compact(history_dir, keep_days=365)
+    # each compaction writes a new data file and removes the old one
+    assert [history.DATA_FILE % 2, history.INDEX_FILE] == sorted(os.listdir(history_dir))
+    assert os.path.getsize(os.path.join(history_dir, history.DATA_FILE % 2)) < size
+    assert [today, today, today] == [entry['date'] for entry in history.query('FooBar', history_dir)]
+    assert [today] == [entry['date'] for entry in history.query('BarFoo', history_dir)]
+
+def test_interrupted_compact(tmp_path):
+    "a compaction that fails part way through leaves the history as it was"
+    history_dir = str(tmp_path)
+    history.append('humans-report-2019-01-01.json', report('FooBar'), '2019-01-01', False, history_dir)
+    with patch('src.history.os.fsync', side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            history.compact(history_dir)
+    assert ['2019-01-01'] == [entry['date'] for entry in history.query('FooBar', history_dir)]
+    # the partial data file is overwritten by the next compaction
+    assert 1 == history.compact(history_dir)
+    assert ['2019-01-01'] == [entry['date'] for entry in history.query('FooBar', history_dir)]
@@ -0,0 +1,82 @@
+import io
+import json
+import logging
+from datetime import datetime
+from src import logs
+
+def test_json_log_lines():
+    stream = io.StringIO()
+    listener = logs.configure('DEBUG', stream=stream)
+    try:
+        log = logging.getLogger('src.main')
+        log.info('deleted key', extra={'user': 'FooBar', 'phase': 'execute', 'duration': 0.5})
+        log.debug('noisy')
+    finally:
+        logs.stop(listener)
+        logging.getLogger(logs.ROOT).handlers.clear()
+        logging.getLogger(logs.ROOT).propagate = True
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert ['deleted key', 'noisy'] == [line['message'] for line in lines]
+    assert {'user': 'FooBar', 'phase': 'execute', 'duration': 0.5}.items() <= lines[0].items()
+    assert 'INFO' == lines[0]['level']
+
+def test_log_level_filters():
+    stream = io.StringIO()
+    listener = logs.configure('WARNING', stream=stream)
+    try:
+        logging.getLogger('src.main').info('quiet')
+    finally:
+        logs.stop(listener)
+        logging.getLogger(logs.ROOT).handlers.clear()
+        logging.getLogger(logs.ROOT).propagate = True
+    assert '' == stream.getvalue()
+
+def test_timed(caplog):
+    log = logging.getLogger('src.test')
+    with caplog.at_level(logging.INFO, logger='src'):
+        with logs.timed(log, 'did thing', user='FooBar'):
+            pass
+    record = caplog.records[0]
+    assert 'did thing' == record.getMessage()
+    assert 'FooBar' == record.user
+    assert record.duration >= 0
+
+def test_log_time_is_event_time():
+    "the time of a log line is when it was logged, not when it was written"
+    record = logging.LogRecord('src.main', logging.INFO, __file__, 1, 'queued', (), None)
+    record.created = 0.0
+    line = json.loads(logs.JSONFormatter().format(record))
+    assert datetime.fromisoformat('1970-01-01T00:00:00+00:00') == datetime.fromisoformat(line['time'])
+
+def test_exception_log_lines():
+    "a traceback is kept in its own field and the message stays on one line"
+    stream = io.StringIO()
+    listener = logs.configure('INFO', stream=stream)
+    try:
+        try:
+            raise RuntimeError("github is down")
+        except RuntimeError:
+            logging.getLogger('src.main').exception('gist failed', extra={'user': 'FooBar'})
+    finally:
+        logs.stop(listener)
+        logging.getLogger(logs.ROOT).handlers.clear()
+        logging.getLogger(logs.ROOT).propagate = True
+
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert 1 == len(lines)
+    assert 'gist failed' == lines[0]['message']
+    assert 'FooBar' == lines[0]['user']
+    assert lines[0]['exception'].startswith('Traceback')
+    assert 'RuntimeError: github is down' in lines[0]['exception']
+
+def test_stop_twice():
+    "stopping a stopped listener, as happens at exit after a test has stopped it, does nothing"
+    listener = logs.configure('INFO', stream=io.StringIO())
+    try:
+        logs.stop(listener)
+        assert listener.stopped
+        logs.stop(listener)
+    finally:
+        logging.getLogger(logs.ROOT).handlers.clear()
+        logging.getLogger(logs.ROOT).propagate = True
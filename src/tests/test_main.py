@@ -2,8 +2,11 @@ import pytest
 from src import main
 from src import utils
 from datetime import timedelta, datetime
-from unittest.mock import patch, DEFAULT
+from unittest.mock import patch, DEFAULT, MagicMock
 import os
+import logging
+import time
+import json
 from os.path import join
 
 FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -227,3 +230,366 @@ def test_bad_rows_bad_email():
     with pytest.raises(AssertionError) as err:
         main.read_input(fixture)
     assert str(err.value).startswith("bad-value: email doesn't look like an email to me")
+
+#
+#
+#
+
+def test_user_report_keys():
+    "the keys a plan was made from are included in the report, without their boto3 objects"
+    test_csv_row = {'iam-username': 'FooBar'}
+    two_days_ago = utils.utcnow() - timedelta(days=2)
+    key_list = [{'access_key_id': 'AKIA-DUMMY', 'create_date': two_days_ago, 'status': 'Active', '-obj': object()}]
+    with patch('src.main.key_list', return_value=key_list):
+        updated_csv_row = main.user_report(test_csv_row, 90, 7)
+    expected = [{'access_key_id': 'AKIA-DUMMY', 'create_date': two_days_ago, 'status': 'Active'}]
+    assert expected == updated_csv_row['keys']
+
+def test_enrich_last_used():
+    "only active keys are looked up"
+    an_hour_ago = utils.utcnow() - timedelta(hours=1)
+    rows = [
+        {'keys': [{'access_key_id': 'AKIA-DUMMY1', 'status': 'Active'}, {'access_key_id': 'AKIA-DUMMY2', 'status': 'Inactive'}]},
+        {'keys': [{'access_key_id': 'AKIA-DUMMY3', 'status': 'Active'}]},
+    ]
+    last_used = {'last-used-date': an_hour_ago, 'last-used-service': 's3', 'last-used-region': 'us-east-1'}
+    with patch('src.main._key_last_used', return_value=last_used) as mock:
+        main.enrich_last_used(rows, workers=2)
+    assert 2 == mock.call_count
+    assert an_hour_ago == rows[0]['keys'][0]['last-used-date']
+    assert 'last-used-date' not in rows[0]['keys'][1]
+    assert 's3' == rows[1]['keys'][0]['last-used-service']
+
+def test_enrich_last_used_is_not_cached_between_plans():
+    "a key is looked up once per plan and again in the next plan"
+    rows = [{'keys': [{'access_key_id': 'AKIA-DUMMY1', 'status': 'Active'}]}, {'keys': [{'access_key_id': 'AKIA-DUMMY1', 'status': 'Active'}]}]
+    with patch('src.main._key_last_used', return_value={'last-used-date': None}) as mock:
+        main.enrich_last_used(rows, workers=2)
+        assert 1 == mock.call_count
+        main.enrich_last_used(rows, workers=2)
+        assert 2 == mock.call_count
+
+def test_key_last_used_failure():
+    with patch('src.main._key_last_used', side_effect=RuntimeError("throttled")):
+        assert {'last-used-error': 'throttled'} == main.key_last_used('AKIA-DUMMY')
+
+def test_hold_keys_in_use():
+    "the disabling of an old key is held while it is still in use"
+    an_hour_ago, a_month_ago = utils.utcnow() - timedelta(hours=1), utils.utcnow() - timedelta(days=30)
+    report = {
+        'state': main.ALL_CREDENTIALS_ACTIVE,
+        'actions': [('disable', 'AKIA-DUMMY1')],
+        'keys': [
+            {'access_key_id': 'AKIA-DUMMY1', 'status': 'Active', 'last-used-date': an_hour_ago},
+            {'access_key_id': 'AKIA-DUMMY2', 'status': 'Active', 'last-used-date': an_hour_ago},
+        ]
+    }
+    result = main.hold_keys_in_use(report, hold_days=7)
+    assert [] == result['actions']
+    assert main.KEY_IN_USE == result['state']
+    assert ['AKIA-DUMMY1'] == result['held']
+
+    # not used recently
+    report['actions'] = [('disable', 'AKIA-DUMMY1')]
+    report['state'] = main.ALL_CREDENTIALS_ACTIVE
+    report['keys'][0]['last-used-date'] = a_month_ago
+    result = main.hold_keys_in_use(report, hold_days=7)
+    assert [('disable', 'AKIA-DUMMY1')] == result['actions']
+    assert main.ALL_CREDENTIALS_ACTIVE == result['state']
+
+def test_hold_keys_in_use_failed_lookup():
+    "a key whose last use couldn't be looked up isn't disabled"
+    report = {
+        'state': main.ALL_CREDENTIALS_ACTIVE,
+        'actions': [('disable', 'AKIA-DUMMY1')],
+        'keys': [
+            {'access_key_id': 'AKIA-DUMMY1', 'status': 'Active'},
+            {'access_key_id': 'AKIA-DUMMY2', 'status': 'Active'},
+        ]
+    }
+    with patch('src.main._key_last_used', side_effect=RuntimeError("throttled")):
+        main.enrich_last_used([report], workers=1)
+    result = main.hold_keys_in_use(report, hold_days=7)
+    assert [] == result['actions']
+    assert main.KEY_IN_USE == result['state']
+    assert 'throttled' == result['keys'][0]['last-used-error']
+
+def test_prefetch():
+    "users that don't exist are absent from the index without being looked up"
+    keys = {
+        'FooBar': [{'access_key_id': 'AKIA-DUMMY', 'create_date': utils.utcnow(), 'status': 'Active'}],
+        'BarFoo': [],
+    }
+    with patch('src.main.list_usernames', return_value={'FooBar', 'BarFoo', 'Other'}):
+        with patch('src.main._list_access_keys', side_effect=keys.get) as mock:
+            key_index = main.prefetch(['FooBar', 'Missing', 'BarFoo', 'FooBar'], workers=2)
+    assert 2 == mock.call_count
+    assert keys == key_index
+    assert ['FooBar', 'BarFoo'] == list(key_index.keys())
+
+def test_prefetch_failures():
+    "a user deleted since users were listed isn't found, a user whose keys can't be listed fails alone"
+    from botocore.exceptions import ClientError
+    def list_access_keys(iam_username):
+        if iam_username == 'Deleted':
+            raise ClientError({'Error': {'Code': 'NoSuchEntity', 'Message': 'not found'}}, 'ListAccessKeys')
+        if iam_username == 'Throttled':
+            raise RuntimeError("throttled")
+        return []
+
+    rows = [{'iam-username': username} for username in ['FooBar', 'Deleted', 'Throttled']]
+    with patch('src.main.list_usernames', return_value={'FooBar', 'Deleted', 'Throttled'}):
+        with patch('src.main._list_access_keys', side_effect=list_access_keys):
+            pass_rows, fail_rows, _ = main.plan(rows, last_used=False)
+
+    assert ['FooBar'] == [row['iam-username'] for row in pass_rows]
+    assert [('Deleted', main.USER_NOT_FOUND), ('Throttled', main.LOOKUP_FAILED)] == [(row['iam-username'], row['state']) for row in fail_rows]
+    assert 'throttled' == fail_rows[1]['error']
+
+def test_plan_latency():
+    "the latency of a call is measured from the concurrent ListAccessKeys calls, not the sequential ListUsers pages"
+    def list_usernames():
+        time.sleep(0.3)
+        return {'A', 'B', 'C'}
+
+    def list_access_keys(iam_username):
+        time.sleep(0.1)
+        return []
+
+    rows = [{'iam-username': username} for username in ['A', 'B', 'C']]
+    with patch.multiple('src.main', list_usernames=DEFAULT, _list_access_keys=DEFAULT) as mocks:
+        mocks['list_usernames'].side_effect = list_usernames
+        mocks['_list_access_keys'].side_effect = list_access_keys
+        _, _, iam_latency = main.plan(rows, last_used=False, workers=10)
+    assert 0.09 < iam_latency < 0.2
+
+def test_user_report_key_index():
+    "a user missing from the key index isn't found and no lookups are made"
+    one_year_ago = utils.utcnow() - timedelta(days=365)
+    key_index = {'FooBar': [{'access_key_id': 'AKIA-DUMMY', 'create_date': one_year_ago, 'status': 'Active'}]}
+    with patch('src.main.key_list') as mock:
+        found = main.user_report({'iam-username': 'FooBar'}, 90, 7, key_index)
+        missing = main.user_report({'iam-username': 'Missing'}, 90, 7, key_index)
+    assert 0 == mock.call_count
+    assert [('create', 'new')] == found['actions']
+    assert main.USER_NOT_FOUND == missing['state']
+
+#
+#
+#
+
+def write_plan(path, passes, fails=None):
+    with open(path, 'w') as fh:
+        fh.write(utils.lossy_json_dumps({'passes': passes, 'fails': fails or []}))
+    return str(path)
+
+def test_load_plan(tmp_path):
+    passes = [{'iam-username': 'FooBar', 'actions': [['disable', 'AKIA-DUMMY1']], 'keys': []}]
+    path = write_plan(tmp_path / 'humans-report-2019-01-01.json', passes, [{'iam-username': 'Missing'}])
+    pass_rows, fail_rows = main.load_plan(path)
+    assert [('disable', 'AKIA-DUMMY1')] == pass_rows[0]['actions']
+    assert [{'iam-username': 'Missing'}] == fail_rows
+
+def test_load_plan_bad_plans(tmp_path):
+    results = write_plan(tmp_path / 'humans-results-2019-01-01.json', [])
+    no_keys = write_plan(tmp_path / 'humans-report-2019-01-01.json', [{'iam-username': 'FooBar', 'actions': []}])
+    for path in [results, no_keys, str(tmp_path / 'humans-report-2019-01-02.json')]:
+        with pytest.raises(AssertionError):
+            main.load_plan(path)
+
+def test_execute_planned_user_report():
+    "actions are only executed if the user's keys are as they were when the plan was made"
+    def plan():
+        return {
+            'iam-username': 'FooBar',
+            'actions': [('disable', 'AKIA-DUMMY1')],
+            'keys': [{'access_key_id': 'AKIA-DUMMY1', 'status': 'Active'}, {'access_key_id': 'AKIA-DUMMY2', 'status': 'Active'}],
+        }
+    unchanged = [{'access_key_id': 'AKIA-DUMMY2', 'status': 'Active'}, {'access_key_id': 'AKIA-DUMMY1', 'status': 'Active'}]
+    changed = [{'access_key_id': 'AKIA-DUMMY1', 'status': 'Inactive'}, {'access_key_id': 'AKIA-DUMMY2', 'status': 'Active'}]
+
+    with patch.multiple('src.main', _list_access_keys=DEFAULT, disable_planned_key=DEFAULT) as mocks:
+        mocks['_list_access_keys'].return_value = unchanged
+        result = main.execute_planned_user_report(plan())
+        assert {'disable': mocks['disable_planned_key'].return_value} == dict(result['results'])
+
+        mocks['_list_access_keys'].return_value = changed
+        result = main.execute_planned_user_report(plan())
+        assert main.STALE_PLAN == result['state']
+        assert [] == result['actions']
+        assert [('disable', 'AKIA-DUMMY1')] == result['planned-actions']
+
+        # user no longer exists
+        mocks['_list_access_keys'].side_effect = RuntimeError("NoSuchEntity")
+        result = main.execute_planned_user_report(plan())
+        assert main.STALE_PLAN == result['state']
+
+        assert 1 == mocks['disable_planned_key'].call_count
+
+def test_execute_planned_user_report_calls():
+    "once the plan is found to be current, keys are mutated without looking the user up again"
+    report = {
+        'iam-username': 'FooBar',
+        'actions': [('delete', 'AKIA-DUMMY1'), ('disable', 'AKIA-DUMMY2')],
+        'keys': [{'access_key_id': 'AKIA-DUMMY1', 'status': 'Inactive'}, {'access_key_id': 'AKIA-DUMMY2', 'status': 'Active'}],
+    }
+    client = MagicMock()
+    with patch.multiple('src.main', _list_access_keys=DEFAULT, _get_user=DEFAULT, iam_client=DEFAULT) as mocks:
+        mocks['_list_access_keys'].return_value = report['keys']
+        mocks['iam_client'].return_value = client
+        result = main.execute_planned_user_report(report)
+    assert {'delete': True, 'disable': True} == dict(result['results'])
+    client.delete_access_key.assert_called_once_with(UserName='FooBar', AccessKeyId='AKIA-DUMMY1')
+    client.update_access_key.assert_called_once_with(UserName='FooBar', AccessKeyId='AKIA-DUMMY2', Status='Inactive')
+    assert not mocks['_get_user'].called
+
+def test_execute_plan(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    keys = [{'access_key_id': 'AKIA-DUMMY1', 'status': 'Inactive'}]
+    passes = [
+        {'iam-username': 'FooBar', 'success?': True, 'actions': [['delete', 'AKIA-DUMMY1']], 'keys': keys},
+        # key has since been deleted
+        {'iam-username': 'BarFoo', 'success?': True, 'actions': [['delete', 'AKIA-DUMMY2']], 'keys': [{'access_key_id': 'AKIA-DUMMY2', 'status': 'Inactive'}]},
+    ]
+    path = write_plan(tmp_path / ('humans-shard-1-of-2-report-%s.json' % utils.ymd(utils.utcnow())), passes)
+    with patch.multiple('src.main', _list_access_keys=DEFAULT, delete_planned_key=DEFAULT) as mocks:
+        mocks['_list_access_keys'].side_effect = lambda username: keys if username == 'FooBar' else []
+        mocks['delete_planned_key'].return_value = True
+        assert 1 == main.execute_plan(path, history_dir=None)
+    assert 1 == mocks['delete_planned_key'].call_count
+    assert os.path.exists('humans-shard-1-of-2-results-%s.json' % utils.ymd(utils.utcnow()))
+
+def test_execute_and_notify():
+    "users with new credentials get a gist and an email, other users are executed but not notified"
+    reports = [
+        {'iam-username': 'FooBar', 'actions': [('create', 'new')]},
+        {'iam-username': 'BarFoo', 'actions': [('delete', 'AKIA-DUMMY')]},
+    ]
+    with patch.multiple('src.main', create_key=DEFAULT, delete_key=DEFAULT, gh_create_user_gist=DEFAULT, email_user__new_credentials=DEFAULT) as mocks:
+        mocks['gh_create_user_gist'].side_effect = lambda row: dict(row, gist=True)
+        mocks['email_user__new_credentials'].side_effect = lambda row: dict(row, email=True)
+        results = main.split_notified(main.execute_and_notify(reports))
+
+    assert ['FooBar'] == [row['iam-username'] for row in results['notified']]
+    assert results['notified'][0]['gist'] and results['notified'][0]['email']
+    assert ['BarFoo'] == [row['iam-username'] for row in results['unnotified']]
+    assert 'gist' not in results['unnotified'][0]
+
+def test_execute_uses_warm_client():
+    "each run's pipeline threads share one IAM client rather than building their own session"
+    report = {'iam-username': 'FooBar', 'actions': [('delete', 'AKIA-DUMMY')]}
+    main.iam_client.cache_clear()
+    try:
+        with patch.multiple('src.main', boto3=DEFAULT, _list_access_keys=DEFAULT) as mocks:
+            mocks['_list_access_keys'].return_value = [{'access_key_id': 'AKIA-DUMMY', 'status': 'Inactive'}]
+            for _ in range(3):
+                results = main.execute_and_notify([dict(report)])
+                assert {'delete': True} == dict(results[0]['results'])
+        assert 1 == mocks['boto3'].client.call_count
+        assert 3 == mocks['boto3'].client.return_value.delete_access_key.call_count
+        assert not mocks['boto3'].session.Session.called
+    finally:
+        main.iam_client.cache_clear()
+
+def test_execute_and_notify_failure_phase(caplog):
+    "a failure to notify a user is logged as a notify failure"
+    report = {'iam-username': 'FooBar', 'actions': [('create', 'new')]}
+    with patch.multiple('src.main', create_key=DEFAULT, gh_create_user_gist=DEFAULT) as mocks:
+        mocks['create_key'].return_value = {'aws-access-key': 'AKIA-DUMMY', 'aws-secret-key': 'secret'}
+        mocks['gh_create_user_gist'].side_effect = RuntimeError("github is down")
+        with caplog.at_level(logging.ERROR, logger='src'):
+            main.execute_and_notify([report])
+    assert ['notify'] == [record.phase for record in caplog.records]
+
+def test_execute_and_notify_failures():
+    "a user whose step fails is recorded as failed, without their secrets, and other users carry on"
+    reports = [{'iam-username': name, 'success?': True, 'actions': [('create', 'new')]} for name in ['A', 'B', 'C']]
+
+    def gist(row):
+        if row['iam-username'] == 'B':
+            raise RuntimeError("github is down")
+        return dict(row, gist=True)
+
+    with patch.multiple('src.main', create_key=DEFAULT, gh_create_user_gist=DEFAULT, email_user__new_credentials=DEFAULT) as mocks:
+        mocks['create_key'].return_value = {'aws-access-key': 'AKIA-DUMMY', 'aws-secret-key': 'secret'}
+        mocks['gh_create_user_gist'].side_effect = gist
+        mocks['email_user__new_credentials'].side_effect = lambda row: dict(row, email=True)
+        results = main.execute_and_notify(reports, queue_size=1)
+
+    by_name = {row['iam-username']: row for row in results}
+    assert ['A', 'B', 'C'] == sorted(by_name)
+    assert by_name['A']['email'] and by_name['C']['email']
+    failed = by_name['B']
+    assert (False, 'github is down', '_gist_stage') == (failed['success?'], failed['error'], failed['failed-step'])
+    assert '[redacted]' == failed['results']['create']['aws-secret-key']
+    assert 2 == mocks['email_user__new_credentials'].call_count
+
+def test_execute_plan_failures(tmp_path, monkeypatch):
+    "the results of a run are written even if some users fail"
+    monkeypatch.chdir(tmp_path)
+    def planned(username):
+        return {'iam-username': username, 'success?': True, 'actions': [['delete', 'AKIA-' + username]],
+                'keys': [{'access_key_id': 'AKIA-' + username, 'status': 'Inactive'}]}
+    path = write_plan(tmp_path / ('humans-report-%s.json' % utils.ymd(utils.utcnow())), [planned('FooBar'), planned('BarFoo')])
+
+    def delete(username, key_id):
+        if username == 'BarFoo':
+            raise RuntimeError("throttled")
+        return True
+
+    with patch.multiple('src.main', _list_access_keys=DEFAULT, delete_planned_key=DEFAULT) as mocks:
+        mocks['_list_access_keys'].side_effect = lambda username: planned(username)['keys']
+        mocks['delete_planned_key'].side_effect = delete
+        assert 1 == main.execute_plan(path, history_dir=None)
+
+    with open('humans-results-%s.json' % utils.ymd(utils.utcnow())) as fh:
+        results = json.load(fh)
+    assert ['FooBar'] == [row['iam-username'] for row in results['passes']['unnotified']]
+    assert [('BarFoo', 'throttled')] == [(row['iam-username'], row['error']) for row in results['fails']]
+
+#
+#
+#
+
+def test_overdue_days():
+    test_csv_row = {'iam-username': 'FooBar'}
+    key_list = [{'access_key_id': 'AKIA-DUMMY', 'create_date': utils.utcnow() - timedelta(days=100), 'status': 'Active'}]
+    with patch('src.main.key_list', return_value=key_list):
+        updated_csv_row = main.user_report(test_csv_row, 90, 7)
+    assert 10 == updated_csv_row['overdue-days']
+
+def test_schedule_waves():
+    "the most overdue users are rotated first, the rest are deferred to later waves"
+    def row(iam_username, overdue_days, actions=None):
+        return {'iam-username': iam_username, 'state': main.OLD_CREDENTIALS, 'overdue-days': overdue_days,
+                'actions': actions or [('create', 'new')]}
+    rows = [
+        row('A', 1),
+        row('B', 300, [('delete', 'AKIA-DUMMY'), ('create', 'new')]),
+        row('C', 50),
+        {'iam-username': 'D', 'state': main.IDEAL, 'actions': []},
+        row('E', 2),
+    ]
+    main.schedule_waves(rows, max_creates=2)
+    waves = {r['iam-username']: r.get('wave') for r in rows}
+    assert {'A': 1, 'B': 0, 'C': 0, 'D': None, 'E': 1} == waves
+
+    by_name = {r['iam-username']: r for r in rows}
+    assert [('delete', 'AKIA-DUMMY'), ('create', 'new')] == by_name['B']['actions']
+    assert main.ROTATION_DEFERRED == by_name['E']['state']
+    assert [] == by_name['E']['actions']
+
+def test_schedule_waves_no_credentials_first():
+    "users without any credentials are never deferred behind users who still have a working key"
+    rows = [{'iam-username': 'Old', 'state': main.OLD_CREDENTIALS, 'overdue-days': 300, 'actions': [('create', 'new')]},
+            {'iam-username': 'New', 'state': main.NO_CREDENTIALS, 'actions': [('create', 'new')]}]
+    waves = {r['iam-username']: r['wave'] for r in main.schedule_waves(rows, max_creates=1)}
+    assert {'New': 0, 'Old': 1} == waves
+
+def test_schedule_waves_stable():
+    "users equally overdue are ordered by a stable hash of their username, not by their order in the csv"
+    rows = [{'iam-username': 'User%s' % i, 'overdue-days': 5, 'actions': [('create', 'new')]} for i in range(20)]
+    first = {r['iam-username']: r['wave'] for r in main.schedule_waves([dict(r) for r in rows], 5)}
+    second = {r['iam-username']: r['wave'] for r in main.schedule_waves([dict(r) for r in reversed(rows)], 5)}
+    assert first == second
+    assert [5, 5, 5, 5] == [list(first.values()).count(wave) for wave in range(4)]
@@ -0,0 +1,57 @@
+import time
+import threading
+import pytest
+from src import pipeline
+
+def test_run():
+    results = pipeline.run(range(20), [lambda x: x + 1, lambda x: x * 2])
+    assert [(x + 1) * 2 for x in range(20)] == results
+
+def test_stages_overlap():
+    "an item moves to the next stage without waiting for the other items"
+    first_item_done = threading.Event()
+
+    def slow_first_stage(x):
+        if x == 1:
+            # the second item can't finish the first stage until the first item has finished the last stage
+            assert first_item_done.wait(timeout=5)
+        return x
+
+    def last_stage(x):
+        if x == 0:
+            first_item_done.set()
+        return x
+
+    assert [0, 1] == pipeline.run([0, 1], [slow_first_stage, last_stage])
+
+def test_bounded_queues():
+    "a fast stage can't run too far ahead of a slow one"
+    started, finished, leads = [], [], []
+
+    def fast(x):
+        started.append(x)
+        leads.append(len(started) - len(finished))
+        return x
+
+    def slow(x):
+        time.sleep(0.005)
+        finished.append(x)
+        return x
+
+    pipeline.run(range(50), [fast, slow], queue_size=1)
+    # one item being processed by the slow stage, one waiting between stages and one waiting to be put in the queue
+    assert max(leads) <= 3
+
+def test_errors():
+    "items already started are finished before the first error is raised"
+    finished = []
+
+    def explode(x):
+        if x == 3:
+            raise ValueError("boom")
+        return x
+
+    with pytest.raises(ValueError):
+        pipeline.run(range(10), [explode, finished.append], queue_size=1)
+    assert 3 not in finished
+    assert [0, 1, 2] == finished[:3]
@@ -0,0 +1,55 @@
+import os
+import pstats
+import pytest
+from src import profiling, pipeline
+
+def test_disabled_profiler_records_nothing():
+    profiler = profiling.Profiler(enabled=False)
+    with profiler.phase('plan'):
+        pass
+    assert profiler.phases == []
+
+def test_phase_is_recorded():
+    profiler = profiling.Profiler(enabled=True)
+    with profiler.phase('plan'):
+        junk = [str(i) for i in range(10000)]
+    assert junk
+    assert ['plan'] == [p['phase'] for p in profiler.phases]
+    phase = profiler.phases[0]
+    assert phase['wall-time'] >= 0
+    assert phase['cpu-time'] >= 0
+    assert phase['memory-peak'] > 0
+    assert phase['top-allocations']
+
+def test_phase_recorded_on_error():
+    profiler = profiling.Profiler(enabled=True)
+    with pytest.raises(ValueError):
+        with profiler.phase('execute'):
+            raise ValueError("boom")
+    assert ['execute'] == [p['phase'] for p in profiler.phases]
+
+def test_nested_phases_not_supported():
+    profiler = profiling.Profiler(enabled=True)
+    with pytest.raises(AssertionError):
+        with profiler.phase('outer'):
+            with profiler.phase('inner'):
+                pass
+
+def test_cprofile_stats_dumped(tmp_path):
+    stats_dir = str(tmp_path / 'stats')
+    profiler = profiling.Profiler(enabled=True, stats_dir=stats_dir)
+    with profiler.phase('notify'):
+        sum(range(100))
+    assert os.path.exists(os.path.join(stats_dir, 'notify.prof'))
+
+def busy_stage(x):
+    return sum(i * i for i in range(10000)) + x
+
+def test_cprofile_stats_include_threads(tmp_path):
+    "work done in the threads of a pipeline is in the phase's stats"
+    stats_dir = str(tmp_path)
+    profiler = profiling.Profiler(enabled=True, stats_dir=stats_dir)
+    with profiler.phase('execute-and-notify'):
+        pipeline.run(range(3), [busy_stage])
+    stats = pstats.Stats(os.path.join(stats_dir, 'execute-and-notify.prof'))
+    assert [3] == [stat[1] for func, stat in stats.stats.items() if func[2] == 'busy_stage']
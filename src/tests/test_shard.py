@@ -0,0 +1,81 @@
+import os
+import json
+import argparse
+import pytest
+from src import shard, utils
+
+def test_parse_shard():
+    assert (1, 4) == shard.parse_shard('1/4')
+    assert (4, 4) == shard.parse_shard('4/4')
+    for bad in ['0/4', '5/4', '1', 'a/b', '', None]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            shard.parse_shard(bad)
+
+def test_parse_shard_argument():
+    "a bad --shard is reported by argparse with its usage message"
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shard', type=shard.parse_shard)
+    assert (2, 3) == parser.parse_args(['--shard', '2/3']).shard
+    with pytest.raises(SystemExit) as err:
+        parser.parse_args(['--shard', '4/3'])
+    assert 2 == err.value.code
+
+def test_select_partitions_rows():
+    "every row belongs to exactly one shard and shards are roughly even"
+    rows = [{'iam-username': 'User%s' % i} for i in range(1000)]
+    shards = [shard.select(rows, (k, 4)) for k in range(1, 5)]
+    usernames = [row['iam-username'] for rows_ in shards for row in rows_]
+    assert sorted(usernames) == sorted(row['iam-username'] for row in rows)
+    assert all(200 < len(rows_) < 300 for rows_ in shards)
+
+def test_select_is_stable():
+    rows = [{'iam-username': 'FooBar'}, {'iam-username': 'BarFoo'}]
+    assert shard.select(rows, (2, 3)) == shard.select(list(rows), (2, 3))
+
+def test_shard_csvpath():
+    assert '/tmp/humans-shard-1-of-4.csv' == shard.shard_csvpath('/tmp/humans.csv', (1, 4))
+
+def write(path, data):
+    with open(path, 'w') as fh:
+        fh.write(utils.lossy_json_dumps(data))
+    return str(path)
+
+def test_merge_results(tmp_path):
+    paths = [
+        write(tmp_path / 'humans-shard-2-of-2-results-2019-01-01.json',
+              {'passes': {'notified': [{'iam-username': 'B'}], 'unnotified': []}, 'fails': [{'iam-username': 'C'}]}),
+        write(tmp_path / 'humans-shard-1-of-2-results-2019-01-01.json',
+              {'passes': {'notified': [], 'unnotified': [{'iam-username': 'A'}]}, 'fails': []}),
+    ]
+    path = shard.merge(paths, output_dir=str(tmp_path), history_dir=None)
+    assert 'humans-results-2019-01-01.json' == os.path.basename(path)
+    with open(path) as fh:
+        merged = json.load(fh)
+    expected = {
+        'passes': {'notified': [{'iam-username': 'B'}], 'unnotified': [{'iam-username': 'A'}]},
+        'fails': [{'iam-username': 'C'}],
+    }
+    assert expected == merged
+
+def test_merge_reports_with_estimates(tmp_path):
+    def est(calls, seconds):
+        return {'calls': {'iam': {'GetUser': calls}}, 'total-calls': calls, 'latency': {}, 'concurrency': 1,
+                'rate-limits': {}, 'projected-seconds': {'iam': seconds, 'total': seconds}}
+    paths = [
+        write(tmp_path / 'humans-shard-1-of-2-report-2019-01-01.json', {'passes': [{'iam-username': 'A'}], 'fails': [], 'estimate': est(2, 1.0)}),
+        write(tmp_path / 'humans-shard-2-of-2-report-2019-01-01.json', {'passes': [{'iam-username': 'B'}], 'fails': [], 'estimate': est(3, 5.0)}),
+    ]
+    with open(shard.merge(paths, output_dir=str(tmp_path), history_dir=None)) as fh:
+        merged = json.load(fh)
+    assert ['A', 'B'] == [row['iam-username'] for row in merged['passes']]
+    assert {'iam': {'GetUser': 5}} == merged['estimate']['calls']
+    assert 5.0 == merged['estimate']['projected-seconds']['total']
+
+def test_merge_bad_inputs(tmp_path):
+    report = {'passes': [], 'fails': []}
+    a = write(tmp_path / 'humans-shard-1-of-2-report-2019-01-01.json', report)
+    b = write(tmp_path / 'humans-shard-1-of-3-report-2019-01-01.json', report)
+    c = write(tmp_path / 'humans-report-2019-01-01.json', report)
+    for paths in [[a, b], [a, a], [c], []]:
+        with pytest.raises(AssertionError):
+            shard.merge(paths, output_dir=str(tmp_path), history_dir=None)
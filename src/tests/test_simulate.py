@@ -0,0 +1,53 @@
+from datetime import timedelta
+from src import main, simulate, utils
+
+def test_stand_in_is_restored():
+    original = main.iam_resource, main.iam_client, main.utcnow
+    with simulate.stand_in(simulate.FakeIAM(utils.utcnow())):
+        assert original != (main.iam_resource, main.iam_client, main.utcnow)
+    assert original == (main.iam_resource, main.iam_client, main.utcnow)
+
+def test_single_user_rotation():
+    "a single overdue user is rotated on day one, disabled after the grace period and deleted the day after"
+    iam = simulate.FakeIAM(utils.utcnow())
+    iam.add_user('FooBar', [100])
+    rows = [{'name': 'Foo', 'email': 'foo@example.org', 'iam-username': 'FooBar'}]
+
+    daily = []
+    for _ in range(10):
+        daily.append(simulate.simulate_day(iam, rows, max_key_age=90, grace_period_days=7))
+        iam.today += timedelta(days=1)
+
+    assert [1, 0, 0, 0, 0, 0, 0, 0, 0, 0] == [day['creates'] for day in daily]
+    assert [0, 0, 0, 0, 0, 0, 0, 0, 1, 0] == [day['disables'] for day in daily]
+    assert [0, 0, 0, 0, 0, 0, 0, 0, 0, 1] == [day['deletes'] for day in daily]
+    assert daily[0]['emails'] == daily[0]['gists'] == 1
+    # planned as `main.process` plans
+    expected = {'ListUsers': 1, 'ListAccessKeys': 1, 'GetAccessKeyLastUsed': 1, 'CreateAccessKey': 1}
+    assert expected == daily[0]['iam-calls']
+    assert 6 == daily[0]['api-calls'] # including a gist and an email
+    assert 1 == len(iam.users['FooBar'])
+
+def test_simulate():
+    result = simulate.simulate(users=50, days=30, max_key_age=10, grace_period_days=2, max_initial_age=20, seed=1)
+    assert 30 == len(result['daily'])
+    # every user is rotated at least once over three key lifetimes
+    assert result['totals']['creates'] >= 50
+    assert result['peak-api-calls'] == max(day['api-calls'] for day in result['daily'])
+
+def test_simulate_max_creates_per_run():
+    "capping creates flattens the daily peak without losing any rotations"
+    kwargs = dict(users=50, days=30, max_key_age=10, grace_period_days=2, max_initial_age=20, cluster_fraction=0.5, seed=1)
+    uncapped = simulate.simulate(**kwargs)
+    capped = simulate.simulate(max_creates_per_run=5, **kwargs)
+    assert uncapped['peak-creates'] > 5
+    assert 5 == capped['peak-creates']
+    assert capped['peak-deferred'] > 0
+
+def test_simulate_no_prefetch():
+    "without prefetching each user is looked up individually"
+    iam = simulate.FakeIAM(utils.utcnow())
+    iam.add_user('FooBar', [1])
+    rows = [{'name': 'Foo', 'email': 'foo@example.org', 'iam-username': 'FooBar'}]
+    day = simulate.simulate_day(iam, rows, max_key_age=90, grace_period_days=7, prefetch_keys=False, last_used=False)
+    assert {'GetUser': 1, 'ListAccessKeys': 1} == day['iam-calls']
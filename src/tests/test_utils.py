@@ -1,7 +1,13 @@
-from src.utils import ensure
+from src.utils import ensure, stable_hash
 import pytest
 
 def test_ensure():
     ensure(1 == 1, "working")
     with pytest.raises(AssertionError):
         ensure(1 == 2, "not working")
+
+def test_stable_hash():
+    assert stable_hash('FooBar') == stable_hash('FooBar')
+    assert stable_hash('FooBar') != stable_hash('BarFoo')
+    # must never change, shards and waves depend on it
+    assert 464 == stable_hash('FooBar') % 1000
@@ -1,4 +1,5 @@
 import json
+import hashlib
 from datetime import datetime, timezone
 
 def first(x):
@@ -46,3 +47,7 @@ def select_keys(d, key_list):
 
 def keys(d):
     return list(d.keys())
+
+def stable_hash(string):
+    "a hash of `string` that, unlike `hash`, is the same across processes, hosts and python versions"
+    return int(hashlib.sha1(string.encode('utf-8')).hexdigest(), 16)
@@ -2,6 +2,7 @@
 # used to *immediately* rotate the credentials of a specific individual.
 # usage: GH_CREDENTIALS_FILE=/path/to/credentials ./update-iam-prompt.sh
 #        GH_CREDENTIALS_FILE=/path/to/credentials ./update-iam-prompt.sh --execute
+#        GH_CREDENTIALS_FILE=/path/to/credentials ./update-iam-prompt.sh --execute --interactive
 set -e
 
 if [ -z "$GH_CREDENTIALS_FILE" ]; then